@@ -2,25 +2,39 @@ import os
 import re
 import json
 import time
+import asyncio
 import logging
 import pathlib
 import sqlite3
 import datetime
+import tempfile
+import threading
+import contextlib
 
 import pytz
+import orjson
 import uvicorn
 
-from fastapi import FastAPI
+from fastapi import FastAPI, HTTPException, Query, Request, Response
 from fastapi.responses import HTMLResponse
-
-from utils.settings import (
-    data_folder,
-    db_file,
-    editdist_extension,
-    last_updated,
-    run_emergency,
-    run_emergency_failed,
+from pydantic import BaseModel, Field, model_validator
+
+from utils.city_index import (
+    CityIndex,
+    get_grid_cell,
+    grid_distance,
+    is_in_bounds,
+    location_ranges,
 )
+from utils.settings import db_file, last_updated
+from utils import queries
+from utils.http_cache import EncodedBody, get_max_age, select_encoding
+from utils.name_index import NameIndex
+from utils.prefork import serve_prefork
+from utils.read_pool import ReadPool
+from utils.response_cache import ResponseCache
+from utils.server_state import ServerStateWatcher
+from utils.stage_metrics import StageMetrics
 from utils.utils import daily_params, hourly_params, simlpify_string
 
 if not os.path.isfile(last_updated):
@@ -29,22 +43,118 @@ if not os.path.isfile(last_updated):
 
 regex = re.compile("[^a-zA-Z āčēģīķļņšūžĀČĒĢĪĶĻŅŠŪŽ]")
 
-con = sqlite3.connect(f"{db_file}", timeout=5)
-con.enable_load_extension(True)
-con.load_extension(
-    ".".join(editdist_extension.split(".")[:-1])
-)  # getting rid of extension
+db = ReadPool(db_file)
+
+# built on first use and rebuilt after every download
+generation_lock = threading.Lock()
+city_index = None
+name_index = None
+missing_param_cities = frozenset()
+data_generation = None
+
+response_cache = ResponseCache()
+
+# timings for the forecast endpoints, exposed at /api/v1/prometheus - stages nest (a
+# stage includes the db queries that run in it), so they don't add up to the total
+metrics = StageMetrics()
+request_times = metrics.histogram(
+    "meteo_request_duration_seconds", "Time spent in forecast endpoints", "endpoint"
+)
+stage_times = metrics.histogram(
+    "meteo_request_stage_duration_seconds",
+    "Time spent in each stage of building forecast responses",
+    "stage",
+)
+db_times = metrics.histogram(
+    "meteo_db_query_duration_seconds",
+    "Time spent waiting on the db, including getting a connection",
+    "query",
+)
+
+
+def get_cache_metrics():
+    stats = response_cache.stats()
+    return [
+        (
+            "meteo_response_cache_hits_total",
+            "counter",
+            "Responses served from the response cache",
+            stats["hits"],
+        ),
+        (
+            "meteo_response_cache_misses_total",
+            "counter",
+            "Responses that had to be built",
+            stats["misses"],
+        ),
+        (
+            "meteo_response_cache_expired_total",
+            "counter",
+            "Cached responses dropped for being out of date",
+            stats["expired"],
+        ),
+        (
+            "meteo_response_cache_size",
+            "gauge",
+            "Responses currently cached",
+            stats["size"],
+        ),
+    ]
+
+
+metrics.add_collector(get_cache_metrics)
+
+
+def get_cache_stats():
+    # every worker has a cache of its own - these are the totals across all of them
+    _, values = metrics.collect()
+    hits = values.get("meteo_response_cache_hits_total", 0)
+    misses = values.get("meteo_response_cache_misses_total", 0)
+    return {
+        "hits": hits,
+        "misses": misses,
+        "expired": values.get("meteo_response_cache_expired_total", 0),
+        "size": values.get("meteo_response_cache_size", 0),
+        "hit_ratio": hits / (hits + misses) if hits + misses > 0 else 0.0,
+    }
+
+
+server_state = ServerStateWatcher()
+state_poll_interval = 1  # seconds
+
+
+async def poll_server_state():
+    # picking up whatever the download jobs have changed, and rebuilding the indexes
+    # here rather than on the first request that sees the new data - and passing this
+    # worker's metrics on to the others
+    while True:
+        await asyncio.sleep(state_poll_interval)
+        try:
+            if await asyncio.to_thread(server_state.refresh):
+                await asyncio.to_thread(refresh_generation_data)
+        except Exception as e:
+            logging.error(f"Server state refresh FAILED - {e}")
+        try:
+            await asyncio.to_thread(metrics.share)
+        except Exception as e:
+            logging.error(f"Sharing metrics FAILED - {e}")
+
+
+@contextlib.asynccontextmanager
+async def lifespan(app):
+    poller = asyncio.create_task(poll_server_state())
+    yield
+    poller.cancel()
 
-# the cursor doesn't actually do anything in sqlite3, just reusing it
-# https://stackoverflow.com/questions/54395773/what-are-the-side-effects-of-reusing-a-sqlite3-cursor
-cur = con.cursor()
 
 # https://semver.org/
 # Given a version number MAJOR.MINOR.PATCH, increment the:
 #    MAJOR version when you make incompatible API changes
 #    MINOR version when you add functionality in a backward compatible manner
 #    PATCH version when you make backward compatible bug fixes
-app = FastAPI(title="Meteo", version="0.1.0", docs_url=None, redoc_url=None)
+app = FastAPI(
+    title="Meteo", version="0.1.0", docs_url=None, redoc_url=None, lifespan=lifespan
+)
 logging.basicConfig(
     level=logging.DEBUG, format="%(asctime)s [%(levelname)s] %(message)s"
 )
@@ -54,82 +164,124 @@ MIN_PARAM_COUNT = min(len(hourly_params), len(daily_params))
 
 
 def is_emergency():
-    return os.path.isfile(run_emergency)
+    return server_state.current.is_emergency
 
 
 def is_param_missing():
-    return cur.execute("SELECT COUNT(*) FROM missing_params").fetchall()[0][0] > 0
+    refresh_generation_data()
+    return len(missing_param_cities) > 0
 
 
-def has_emergency_failed():
-    return os.path.isfile(run_emergency_failed)
+def get_missing_param_cities():
+    refresh_generation_data()
+    return missing_param_cities
 
 
-def get_location_range(force_all: bool = False, _enable_experimental: bool = False):
+def get_location_types(force_all: bool = False, _enable_experimental: bool = False):
     # TODO: use enable_experimental to enable limited access to new types of locations
     if force_all or not is_emergency():
-        return "('pilsēta', 'ciems', 'cits', 'location_LT')"
+        return location_ranges["all"]
     else:
-        return "('pilsēta', 'location_LT')"
+        return location_ranges["emergency"]
+
+
+def get_generation():
+    # download jobs touch the generation file once they've finished writing new data
+    return server_state.current.generation
+
+
+def get_cursor():
+    with db_times.time("connect"):
+        return db.cursor(get_generation())
+
+
+def refresh_generation_data():
+    # rebuilding the indexes and missing param flags whenever a download job (or the
+    # emergency crawler) publishes a new generation
+    global city_index, name_index, missing_param_cities, data_generation
+    generation = get_generation()
+    if city_index is not None and generation == data_generation:
+        return
+    with generation_lock:
+        if city_index is not None and generation == data_generation:
+            return  # another thread got here first
+        cur = db.cursor(generation)
+        cities = cur.execute(queries.cities).fetchall()
+        city_index = CityIndex(cities)
+        name_index = NameIndex(cities)
+        missing_param_cities = frozenset(
+            e[0] for e in cur.execute(queries.missing_param_cities).fetchall()
+        )
+        data_generation = generation
+        logging.info(
+            f"City indexes rebuilt - {len(city_index)} cities, {len(name_index)} names, {len(missing_param_cities)} cities with missing params"
+        )
+
+
+def get_city_index():
+    refresh_generation_data()
+    return city_index
+
+
+def get_name_index():
+    refresh_generation_data()
+    return name_index
+
+
+def get_grid_city(cur, lat, lon, types):
+    # the download jobs precompute closest cities for the area that most requests come from
+    range_name = [k for k, v in location_ranges.items() if v == types]
+    if len(range_name) == 0:
+        return ()
+    lat_idx, lon_idx = get_grid_cell(lat, lon)
+    try:
+        with db_times.time("city_grid"):
+            cells = cur.execute(
+                queries.city_grid,
+                {
+                    "location_range": range_name[0],
+                    "lat_idx": lat_idx,
+                    "lon_idx": lon_idx,
+                },
+            ).fetchall()
+    except sqlite3.OperationalError:  # the grid hasn't been built yet
+        return ()
+    if len(cells) == 0 or cells[0][0] is None:
+        return ()
+    return get_city_index().get_by_id(cells[0][0], lat, lon)
 
 
 def get_closest_city(
     cur,
     lat,
     lon,
-    distance=7,
+    distance=grid_distance,
     force_all=False,
     only_closest=False,
     ignore_missing_params=True,
     enable_experimental=False,
 ):
-    cities = []
-    only_closest_active = (
-        lat < 55.7 or lat > 58.05 or lon < 20.95 or lon > 28.25 or only_closest
+    only_closest_active = not is_in_bounds(lat, lon) or only_closest
+    skip = None
+    if not ignore_missing_params:
+        skip = get_missing_param_cities()
+
+    types = get_location_types(force_all, enable_experimental)
+    if not only_closest_active and distance == grid_distance and not skip:
+        city = get_grid_city(cur, lat, lon, types)
+        if len(city) > 0:
+            return city
+
+    # distances are in km since that makes messing around with distance values a bit more intuitive
+    city = get_city_index().closest(
+        lat,
+        lon,
+        types,
+        distance=None if only_closest_active else distance,
+        skip=skip,
     )
-    where_order_str = f"""
-        WHERE
-            distance <= {distance}
-        ORDER BY
-            ctype ASC, distance ASC
-    """
-    if only_closest_active:
-        where_order_str = """
-            ORDER BY
-                distance ASC
-        """
-
-    # calculating dist in km since using Euclidean doesn't appear to yield big performance savings
-    # and this makes messing around with distance values a bit more intuitive
-    cities = cur.execute(f"""
-        WITH city_distances AS (
-            SELECT
-                id,
-                name,
-                lat,
-                lon,
-                CASE type
-                    WHEN 'pilseta' THEN 1
-                    WHEN 'ciems' THEN 2
-                    WHEN 'cits' THEN 3
-                    WHEN 'location_LT' THEN 4
-                END as ctype,
-                ACOS((SIN(RADIANS(lat))*SIN(RADIANS({lat})))+(COS(RADIANS(lat))*COS(RADIANS({lat})))*(COS(RADIANS({lon})-RADIANS(lon))))*6371 as distance
-            FROM
-                cities
-            WHERE
-                type IN {get_location_range(force_all, enable_experimental)}
-                {"" if ignore_missing_params else " AND id NOT IN (SELECT city_id FROM missing_params)"}
-        )
-        SELECT
-            id, name, lat, lon, ctype, distance
-        FROM
-            city_distances
-        {where_order_str}
-        LIMIT 1
-    """).fetchall()
-
-    if len(cities) == 0:
+
+    if len(city) == 0:
         if only_closest_active:
             return ()
         else:
@@ -143,354 +295,247 @@ def get_closest_city(
                 ignore_missing_params=ignore_missing_params,
                 enable_experimental=enable_experimental,
             )
-    return cities[0]
+    return city
 
 
 def get_city_by_name(city_name, enable_experimental=False):
-    cities = cur.execute(f"""
-        WITH edit_distances AS (
-            SELECT
-                id,
-                name,
-                lat,
-                lon,
-                CASE type
-                    WHEN 'pilseta' THEN 1
-                    WHEN 'ciems' THEN 2
-                    WHEN 'cits' THEN 3
-                    WHEN 'location_LT' THEN 4
-                END as ctype,
-                fuzzy_editdist(search_name, '{city_name}') AS distance
-            FROM
-                cities
-            WHERE
-                type in {get_location_range(True, enable_experimental)}
-        )
-        SELECT
-            id, name, lat, lon, ctype, distance
-        FROM
-            edit_distances
-        ORDER BY
-            distance ASC, ctype ASC
-        LIMIT 1
-    """).fetchall()
-    if len(cities) == 0:
-        return ()
-    else:
-        return cities[0]
+    return get_name_index().closest(
+        city_name, get_location_types(True, enable_experimental)
+    )
+
 
+def get_forecasts(cur, cities, c_date, query_name):
+    # fetching forecasts for all of the cities in one go, returns rows grouped by city id
+    # (the download jobs store forecasts already pivoted, one row per date)
+    city_ids = sorted({c[0] for c in cities if len(c) > 0})
+    forecasts = {city_id: [] for city_id in city_ids}
+    if len(city_ids) > 0:
+        with db_times.time(query_name):
+            rows = cur.execute(
+                getattr(queries, query_name),
+                {"city_ids": json.dumps(city_ids), "c_date": c_date},
+            ).fetchall()
+        for f in rows:
+            forecasts[f[0]].append(f)
+    return forecasts
 
-def get_forecast(cur, city, c_date, params):
+
+def get_warnings(cur, city, c_date):
     if len(city) == 0:
         return []
-    # pivoting the table and using max to discard nulls
-    return cur.execute(f"""
-        SELECT
-            city_id, date,
-            {",".join([f"IFNULL(MAX(case when param_id={p} then value end), -999) AS val_{p}" for p in params])}
-        FROM
-            forecast_cities AS fc
-        WHERE
-            city_id = '{city[0]}' AND date >= '{c_date}' AND param_id IN ({",".join([str(p) for p in params])})
-        GROUP BY
-            city_id, date
-    """).fetchall()
-
-
-def get_warnings(cur, lat, lon, c_date):
-    # TODO: turning the warning polygons into big squares - this should at least work - should use the actual poly bounds at some point
-    relevant_warnings = cur.execute(f"""
-        SELECT
-            warning_id
-        FROM
-            warning_bounds
-        WHERE
-            {lat} >= min_lat AND {lat} <= max_lat AND {lon} >= min_lon AND {lon} <= max_lon
-    """).fetchall()
-    warnings = []
-    if len(relevant_warnings) > 0:
-        # the weather service occasionally serves the same warnings
-        # for the same area, and with the same text, but with two
-        # different intensity levels - getting only the highest intensity
-        warnings = cur.execute(f"""
-            WITH warning_levels AS (
-                SELECT DISTINCT
-                    id,
-                    CASE intensity_en
-                        WHEN 'Red' THEN 3
-                        WHEN 'Orange' THEN 2
-                        WHEN 'Yellow' THEN 1
-                    END as intensity_level,
-                    type_lv,
-                    description_lv
-                FROM
-                    warnings
-                WHERE
-                    id in ({", ".join([str(w[0]) for w in relevant_warnings])})
-            ),
-            warnings_unique_texts AS (
-                SELECT DISTINCT
-                    max(intensity_level) AS max_intensity,
-                    type_lv,
-                    description_lv
-                FROM
-                    warning_levels
-                GROUP BY
-                    type_lv,
-                    description_lv
-            ),
-            warning_filtered_ids AS (
-                SELECT DISTINCT
-                    id
-                FROM
-                    warning_levels AS wl INNER JOIN warnings_unique_texts AS wt ON
-                        wl.intensity_level = wt.max_intensity
-                        AND wl.type_lv = wt.type_lv
-                        AND wl.description_lv = wt.description_lv
-            ),
-            warnings_raw AS (
-                SELECT DISTINCT
-                    id,
-                    intensity_lv,
-                    intensity_en,
-                    CASE intensity_en
-                        WHEN 'Red' THEN 3
-                        WHEN 'Orange' THEN 2
-                        WHEN 'Yellow' THEN 1
-                    END as intensity_val,
-                    regions_lv,
-                    regions_en,
-                    type_lv,
-                    type_en,
-                    time_from,
-                    time_to,
-                    description_lv,
-                    description_en
-                FROM
-                    warnings
-                WHERE
-                    id in warning_filtered_ids AND time_to > {c_date}
-            )
-            SELECT
-                id,
-                intensity_lv,
-                intensity_en,
-                regions_lv,
-                regions_en,
-                type_lv,
-                type_en,
-                time_from,
-                time_to,
-                description_lv,
-                description_en
-            FROM
-                warnings_raw
-            ORDER BY
-                intensity_val DESC
-        """).fetchall()
-    return warnings
-
-
-def get_simple_warnings(cur, lat, lon, c_date):
-    # TODO: turning the warning polygons into big squares - this should at least work - should use the actual poly bounds at some point
-    relevant_warnings = cur.execute(f"""
-        SELECT
-            warning_id
-        FROM
-            warning_bounds
-        WHERE
-            {lat} >= min_lat AND {lat} <= max_lat AND {lon} >= min_lon AND {lon} <= max_lon
-    """).fetchall()
-    warnings = []
-    if len(relevant_warnings) > 0:
-        # the weather service occasionally serves the same warnings
-        # for the same area, and with the same text, but with two
-        # different intensity levels - getting only the highest intensity
-        warnings = cur.execute(f"""
-            WITH warning_levels AS (
-                SELECT DISTINCT
-                    id,
-                    CASE intensity_en
-                        WHEN 'Red' THEN 3
-                        WHEN 'Orange' THEN 2
-                        WHEN 'Yellow' THEN 1
-                    END as intensity_level,
-                    type_lv,
-                    description_lv
-                FROM
-                    warnings
-                WHERE
-                    id in ({", ".join([str(w[0]) for w in relevant_warnings])})
-            ),
-            warnings_unique_texts AS (
-                SELECT DISTINCT
-                    max(intensity_level) AS max_intensity,
-                    type_lv,
-                    description_lv
-                FROM
-                    warning_levels
-                GROUP BY
-                    type_lv,
-                    description_lv
-            ),
-            warning_filtered_ids AS (
-                SELECT DISTINCT
-                    id
-                FROM
-                    warning_levels AS wl INNER JOIN warnings_unique_texts AS wt ON
-                        wl.intensity_level = wt.max_intensity
-                        AND wl.type_lv = wt.type_lv
-                        AND wl.description_lv = wt.description_lv
-            ),
-            warnings_raw AS (
-                SELECT DISTINCT
-                    id,
-                    type_lv,
-                    type_en,
-                    intensity_lv,
-                    intensity_en,
-                    CASE intensity_en
-                        WHEN 'Red' THEN 3
-                        WHEN 'Orange' THEN 2
-                        WHEN 'Yellow' THEN 1
-                    END as intensity_val,
-                    description_lv,
-                    description_en
-                FROM
-                    warnings
-                WHERE
-                    id in warning_filtered_ids AND time_to > {c_date}
-            )
-            SELECT
-                id,
-                type_lv,
-                type_en,
-                intensity_lv,
-                intensity_en,
-                description_lv,
-                description_en
-            FROM
-                warnings_raw
-            ORDER BY
-                intensity_val DESC
-        """).fetchall()
-    return warnings
-
-
-def get_aurora_probability(cur, lat, lon):
-    aurora_probs = cur.execute(f"""
-        SELECT
-            aurora
-        FROM
-            aurora_prob
-        WHERE
-            lat={lat} AND lon={lon}
-        LIMIT 1
-    """).fetchall()
-    aurora_probs_time = (
-        datetime.datetime.strptime(
-            json.loads(open(f"{data_folder}/ovation_aurora_times.json", "r").read())[
-                "Forecast Time"
-            ],
-            "%Y-%m-%dT%H:%M:%SZ",
-        )
-        .replace(tzinfo=pytz.timezone("UTC"))
-        .astimezone(pytz.timezone("Europe/Riga"))
-    )
+    # the download jobs work out which warnings apply to which cities
+    with db_times.time("warnings"):
+        return cur.execute(
+            queries.warnings, {"city_id": city[0], "c_date": c_date}
+        ).fetchall()
+
+
+def get_simple_warnings(cur, city, c_date):
+    if len(city) == 0:
+        return []
+    with db_times.time("simple_warnings"):
+        return cur.execute(
+            queries.simple_warnings, {"city_id": city[0], "c_date": c_date}
+        ).fetchall()
+
+
+def get_aurora_probability(lat, lon, state):
+    aurora_probs_time = state.aurora_time
     curr_date = datetime.datetime.now(pytz.timezone("Europe/Riga"))
 
     return {
-        "prob": aurora_probs[0][0]
-        if len(aurora_probs) > 0 and aurora_probs_time >= curr_date
+        "prob": state.aurora_grid.get(lat, lon)
+        if state.aurora_grid is not None and aurora_probs_time >= curr_date
         else 0,  # just default to 0 if there's no data
         "time": aurora_probs_time.strftime("%Y%m%d%H%M"),
     }
 
 
+def get_encoded_response(request, encoded):
+    # clients that already have the current body get a 304, everyone else gets the
+    # smallest encoding they accept - nothing gets encoded or compressed here
+    encoding = select_encoding(request.headers.get("accept-encoding"))
+    headers = {
+        "ETag": encoded.etag(encoding),
+        "Cache-Control": f"max-age={get_max_age()}",
+        "Vary": "Accept-Encoding",
+    }
+    if encoded.etag_matches(request.headers.get("if-none-match")):
+        return Response(status_code=304, headers=headers)
+    if encoding != "identity":
+        headers["Content-Encoding"] = encoding
+    return Response(
+        content=encoded.get(encoding), media_type="application/json", headers=headers
+    )
+
+
+def get_cached_city_responses(
+    cur, locations, add_last_no_skip, use_simple_warnings, add_city_coords
+):
+    # locations - (city, h_city) pairs, returns an EncodedBody for each of them
+    c_date = int(
+        datetime.datetime.now(pytz.timezone("Europe/Riga")).strftime("%Y%m%d%H%M")
+    )
+    keys = [
+        (
+            city[0] if len(city) > 0 else None,
+            h_city[0] if len(h_city) > 0 else None,
+            add_last_no_skip,
+            use_simple_warnings,
+            add_city_coords,
+        )
+        for city, h_city in locations
+    ]
+    # responses include bits of the server state, so any change to it invalidates them
+    state = server_state.current
+    encoded = {}
+    missing = {}
+    with stage_times.time("response_cache"):
+        for key, location in zip(keys, locations):
+            if key in encoded or key in missing:
+                continue  # locations that resolved to the same city get built once
+            cached = response_cache.get(key, state.mtimes, c_date)
+            if cached is None:
+                missing[key] = location
+            else:
+                encoded[key] = cached
+
+    if len(missing) > 0:
+        with stage_times.time("hourly_forecast"):
+            h_forecasts = get_forecasts(
+                cur,
+                [h_city for _, h_city in missing.values()],
+                c_date,
+                "forecast_hourly",
+            )
+        with stage_times.time("daily_forecast"):
+            d_forecasts = get_forecasts(
+                cur, [city for city, _ in missing.values()], c_date, "forecast_daily"
+            )
+        for key, (city, h_city) in missing.items():
+            ret_val, valid_until, valid_before = get_city_response(
+                cur,
+                city,
+                add_last_no_skip,
+                h_city,
+                use_simple_warnings,
+                add_city_coords,
+                state,
+                c_date,
+                h_forecasts.get(h_city[0], []) if len(h_city) > 0 else [],
+                d_forecasts.get(city[0], []) if len(city) > 0 else [],
+            )
+            # caching the encoded and compressed body, so that repeat requests skip
+            # FastAPI's encoding and compression altogether
+            with stage_times.time("serialize"):
+                body = orjson.dumps(ret_val)
+            with stage_times.time("compress"):
+                encoded[key] = EncodedBody(body)
+            response_cache.put(
+                key, state.mtimes, encoded[key], valid_until, valid_before
+            )
+    return [encoded[key] for key in keys]
+
+
 # TODO: delete the params that are no longer needed
 def get_city_response(
-    city, add_last_no_skip, h_city, use_simple_warnings, add_city_coords
+    cur,
+    city,
+    add_last_no_skip,
+    h_city,
+    use_simple_warnings,
+    add_city_coords,
+    state,
+    c_date,
+    h_forecast,
+    d_forecast,
 ):
+    # returns the response along with the range of c_dates for which it stays valid
     lat = lon = 0.0
     if len(city) > 0:
         lat = float(city[2])
         lon = float(city[3])
 
-    c_date = datetime.datetime.now(pytz.timezone("Europe/Riga")).strftime("%Y%m%d%H%M")
-    h_forecast = get_forecast(cur, h_city, c_date, hourly_params)
-    d_forecast = get_forecast(cur, city, c_date, daily_params)
-    metadata_f = f"{data_folder}meteorologiskas-prognozes-apdzivotam-vietam-jaunaka-datu-kopa.json"
-    metadata = json.loads(open(metadata_f, "r").read())
+    with stage_times.time("aurora"):
+        aurora_probs = get_aurora_probability(round(lat), round(lon), state)
 
     ret_val = {
         "city": str(city[1]) if len(city) > 0 else "",
-        "hourly_forecast": [{"time": f[1], "vals": f[2:]} for f in h_forecast],
-        "daily_forecast": [
-            {
-                "time": f[1]
-                if str(f[1])[-4:] != "2300"
-                else int(
-                    (
-                        datetime.datetime.strptime(str(f[1]), "%Y%m%d%H%M")
-                        + datetime.timedelta(hours=1)
-                    ).strftime("%Y%m%d%H%M")
-                ),  # dealing with the clock getting turned forward
-                "vals": f[2:],
-            }
-            for f in d_forecast
-        ],
-        "aurora_probs": get_aurora_probability(cur, round(lat), round(lon)),
-        "last_updated": metadata["result"]["metadata_modified"]
-        .replace("-", "")
-        .replace("T", "")
-        .replace(":", "")[:12],
+        "hourly_forecast": [{"time": f[2], "vals": f[3:]} for f in h_forecast],
+        "daily_forecast": [{"time": f[2], "vals": f[3:]} for f in d_forecast],
+        "aurora_probs": aurora_probs,
+        "last_updated": state.last_updated,
         # TODO: get local timezone instead - at the moment I just assume that everyone's in Latvia (could also use UTC and use decides timezone in the app)
-        "last_downloaded": datetime.datetime.fromtimestamp(os.path.getmtime(metadata_f))
-        .replace(tzinfo=pytz.timezone("UTC"))
-        .astimezone(pytz.timezone("Europe/Riga"))
-        .strftime("%Y%m%d%H%M"),
+        "last_downloaded": state.last_downloaded,
     }
 
     if add_city_coords:
         ret_val["lat"] = lat
         ret_val["lon"] = lon
 
-    if use_simple_warnings:
-        warnings = get_simple_warnings(cur, lat, lon, c_date)
-        tmp_warnings = {}
-        for w in warnings:
-            tmp_key = f"{w[1]}:{w[3]}"  # type and intensity
-            if tmp_key not in tmp_warnings:
-                tmp_warnings[tmp_key] = {
-                    "ids": [w[0]],
-                    "type": w[1:3],
-                    "intensity": w[3:5],
-                    "description_lv": [w[5]],
-                    "description_en": [w[6]],
+    with stage_times.time("warnings"):
+        if use_simple_warnings:
+            warnings = get_simple_warnings(cur, city, c_date)
+            tmp_warnings = {}
+            for w in warnings:
+                tmp_key = f"{w[1]}:{w[3]}"  # type and intensity
+                if tmp_key not in tmp_warnings:
+                    tmp_warnings[tmp_key] = {
+                        "ids": [w[0]],
+                        "type": w[1:3],
+                        "intensity": w[3:5],
+                        "description_lv": [w[5]],
+                        "description_en": [w[6]],
+                    }
+                else:
+                    tmp_warnings[tmp_key]["ids"].append(w[0])
+                    tmp_warnings[tmp_key]["description_lv"].append(w[5])
+                    tmp_warnings[tmp_key]["description_en"].append(w[6])
+            ret_val["warnings"] = list(tmp_warnings.values())
+        else:
+            # TODO: get rid of this once noone's using it
+            warnings = get_warnings(cur, city, c_date)
+            ret_val["warnings"] = [
+                {
+                    "id": w[0],
+                    "intensity": w[1:3],
+                    "regions": w[3:5],
+                    "type": w[5:7],
+                    "time": w[7:9],
+                    "description": w[9:],
                 }
-            else:
-                tmp_warnings[tmp_key]["ids"].append(w[0])
-                tmp_warnings[tmp_key]["description_lv"].append(w[5])
-                tmp_warnings[tmp_key]["description_en"].append(w[6])
-        ret_val["warnings"] = list(tmp_warnings.values())
-    else:
-        # TODO: get rid of this once noone's using it
-        warnings = get_warnings(cur, lat, lon, c_date)
-        ret_val["warnings"] = [
-            {
-                "id": w[0],
-                "intensity": w[1:3],
-                "regions": w[3:5],
-                "type": w[5:7],
-                "time": w[7:9],
-                "description": w[9:],
-            }
-            for w in warnings
-        ]
+                for w in warnings
+            ]
 
     if add_last_no_skip:
-        ret_val["last_downloaded_no_skip"] = open(last_updated, "r").readline().strip()
-    return ret_val
+        ret_val["last_downloaded_no_skip"] = state.last_downloaded_no_skip
+
+    # forecasts stop being valid once their first entry is in the past, warnings once
+    # they've expired, and the aurora forecast once its forecast time has passed
+    valid_until = min(
+        [int(f[1]) for f in h_forecast[:1] + d_forecast[:1]], default=99999999999999
+    )
+    valid_before = min(
+        [int(w[8 if not use_simple_warnings else 7]) for w in warnings],
+        default=99999999999999,
+    )
+    aurora_time = int(ret_val["aurora_probs"]["time"])
+    if aurora_time >= c_date:
+        valid_before = min(valid_before, aurora_time)
+    return ret_val, valid_until, valid_before
+
+
+def get_hourly_city(cur, city, enable_experimental):
+    # getting hourly forecast for closest large city if we're in emergency mode
+    if (is_emergency() or is_param_missing()) and len(city) > 0:
+        return get_closest_city(
+            cur=cur,
+            lat=city[2],
+            lon=city[3],
+            ignore_missing_params=False,
+            enable_experimental=enable_experimental,
+        )
+    return city
 
 
 # http://localhost:443/api/v1/forecast/cities?lat=56.9730&lon=24.1327
@@ -498,7 +543,11 @@ def get_city_response(
 @app.head(
     "/api/v1/forecast/cities"
 )  # added for https://stats.uptimerobot.com/EAWZfpoMkw
-async def get_city_forecasts(
+# plain def rather than async def - FastAPI runs these in its threadpool, which keeps
+# the db work off of the event loop
+@request_times.timed("cities")
+def get_city_forecasts(
+    request: Request,
     lat: float,
     lon: float,
     add_last_no_skip: bool = False,
@@ -506,28 +555,28 @@ async def get_city_forecasts(
     add_city_coords: bool = False,
     enable_experimental: bool = False,
 ):
-    city = get_closest_city(
-        cur=cur,
-        lat=lat,
-        lon=lon,
-        force_all=True,
-        enable_experimental=enable_experimental,
-    )  # always getting closest city since override only affects hourly forecasts
-    return get_city_response(
-        city,
-        add_last_no_skip,
-        get_closest_city(
+    cur = get_cursor()
+    with stage_times.time("city"):
+        city = get_closest_city(
             cur=cur,
-            lat=city[2],
-            lon=city[3],
-            ignore_missing_params=False,
+            lat=lat,
+            lon=lon,
+            force_all=True,
             enable_experimental=enable_experimental,
-        )
-        if (is_emergency() or is_param_missing()) and len(city) > 0
-        else city,  # getting hourly forecast for closest large city if we're in emergency mode
+        )  # always getting closest city since override only affects hourly forecasts
+        h_city = get_hourly_city(cur, city, enable_experimental)
+    encoded = get_cached_city_responses(
+        cur,
+        [(city, h_city)],
+        add_last_no_skip,
         use_simple_warnings,
         add_city_coords,
     )
+    return get_encoded_response(request, encoded[0])
+
+
+# the name search gets slower with longer names, and no place name is anywhere near this
+MAX_CITY_NAME_LENGTH = 64
 
 
 # http://localhost:443/api/v1/forecast/cities/name?city_name=vamier
@@ -535,32 +584,89 @@ async def get_city_forecasts(
 @app.head(
     "/api/v1/forecast/cities/name"
 )  # added for https://stats.uptimerobot.com/EAWZfpoMkw
-async def get_city_forecasts_name(
-    city_name: str,
+@request_times.timed("cities_name")
+def get_city_forecasts_name(
+    request: Request,
+    city_name: str = Query(max_length=MAX_CITY_NAME_LENGTH),
     add_last_no_skip: bool = False,
     use_simple_warnings: bool = False,
     add_city_coords: bool = False,
     enable_experimental: bool = False,
 ):
-    city = get_city_by_name(
-        simlpify_string(regex.sub("", city_name).strip().lower()),
-        enable_experimental=enable_experimental,
-    )  # always getting closest city since override only affects hourly forecasts
-    return get_city_response(
-        city,
-        add_last_no_skip,
-        get_closest_city(
-            cur=cur,
-            lat=city[2],
-            lon=city[3],
-            ignore_missing_params=False,
+    cur = get_cursor()
+    with stage_times.time("city"):
+        city = get_city_by_name(
+            simlpify_string(regex.sub("", city_name).strip().lower()),
             enable_experimental=enable_experimental,
-        )
-        if (is_emergency() or is_param_missing()) and len(city) > 0
-        else city,  # getting hourly forecast for closest large city if we're in emergency mode
+        )  # always getting closest city since override only affects hourly forecasts
+        h_city = get_hourly_city(cur, city, enable_experimental)
+    encoded = get_cached_city_responses(
+        cur,
+        [(city, h_city)],
+        add_last_no_skip,
         use_simple_warnings,
         add_city_coords,
     )
+    return get_encoded_response(request, encoded[0])
+
+
+class BatchLocation(BaseModel):
+    # either coordinates or a city name
+    lat: float | None = None
+    lon: float | None = None
+    city_name: str | None = Field(default=None, max_length=MAX_CITY_NAME_LENGTH)
+
+    @model_validator(mode="after")
+    def check_location(self):
+        if self.city_name is None and (self.lat is None or self.lon is None):
+            raise ValueError("either lat and lon, or city_name has to be provided")
+        return self
+
+
+MAX_BATCH_SIZE = 50
+
+
+# curl -X POST "http://localhost:443/api/v1/forecast/cities/batch" -H "Content-Type: application/json" -d '[{"lat": 56.9730, "lon": 24.1327}, {"city_name": "vamier"}]'
+@app.post("/api/v1/forecast/cities/batch")
+@request_times.timed("cities_batch")
+def get_city_forecasts_batch(
+    locations: list[BatchLocation],
+    add_last_no_skip: bool = False,
+    use_simple_warnings: bool = False,
+    add_city_coords: bool = False,
+    enable_experimental: bool = False,
+):
+    if len(locations) > MAX_BATCH_SIZE:
+        raise HTTPException(
+            status_code=422,
+            detail=f"at most {MAX_BATCH_SIZE} locations can be requested at once",
+        )
+    cur = get_cursor()
+    resolved = []
+    for loc in locations:
+        with stage_times.time("city"):
+            if loc.city_name is not None:
+                city = get_city_by_name(
+                    simlpify_string(regex.sub("", loc.city_name).strip().lower()),
+                    enable_experimental=enable_experimental,
+                )
+            else:
+                city = get_closest_city(
+                    cur=cur,
+                    lat=loc.lat,
+                    lon=loc.lon,
+                    force_all=True,
+                    enable_experimental=enable_experimental,
+                )
+            resolved.append((city, get_hourly_city(cur, city, enable_experimental)))
+    encoded = get_cached_city_responses(
+        cur, resolved, add_last_no_skip, use_simple_warnings, add_city_coords
+    )
+    # the cached bodies are already encoded, so they just need to be stitched together
+    return Response(
+        content=b"[" + b",".join([e.body for e in encoded]) + b"]",
+        media_type="application/json",
+    )
 
 
 # http://localhost:443/privacy-policy
@@ -595,27 +701,22 @@ async def get_privacy_attribution(lang: str = "en"):
 # http://localhost:443/api/v1/meta
 @app.get("/api/v1/meta")
 @app.head("/api/v1/meta")  # added for https://stats.uptimerobot.com/EAWZfpoMkw
-async def get_meta():
-    aurora_probs_time = (
-        datetime.datetime.strptime(
-            json.loads(open(f"{data_folder}/ovation_aurora_times.json", "r").read())[
-                "Forecast Time"
-            ],
-            "%Y-%m-%dT%H:%M:%SZ",
-        )
-        .replace(tzinfo=pytz.timezone("UTC"))
-        .astimezone(pytz.timezone("Europe/Riga"))
-    )
+def get_meta():
+    state = server_state.current
     curr_date = datetime.datetime.now(pytz.timezone("Europe/Riga"))
 
     retval = {
-        "is_emergency": is_emergency(),
+        "is_emergency": state.is_emergency,
         "is_param_missing": is_param_missing(),
-        "is_aurora_ood": (aurora_probs_time < curr_date),
+        "is_aurora_ood": (state.aurora_time < curr_date),
+        "response_cache": get_cache_stats(),
+        "has_update_failed": state.update_failed != "",
     }
     if retval["is_emergency"]:
-        retval["emergency_dl"] = open(run_emergency, "r").readline()
-        retval["has_emergency_failed"] = has_emergency_failed()
+        retval["emergency_dl"] = state.emergency_dl
+        retval["has_emergency_failed"] = state.has_emergency_failed
+    if retval["has_update_failed"]:
+        retval["update_failed"] = state.update_failed  # update time and failed tables
     return retval
 
 
@@ -623,49 +724,20 @@ async def get_meta():
 @app.get("/api/v1/version")
 @app.head("/api/v1/version")  # added for https://stats.uptimerobot.com/EAWZfpoMkw
 async def get_version():
+    state = server_state.current
     return {
-        "version": open("version.txt", "r").read().strip(),
-        "updated": datetime.datetime.fromtimestamp(os.path.getmtime("version.txt"))
-        .replace(tzinfo=pytz.timezone("UTC"))
-        .astimezone(pytz.timezone("Europe/Riga"))
-        .strftime("%Y%m%d%H%M"),
+        "version": state.version,
+        "updated": state.version_updated,
     }
 
 
 # http://localhost:443/api/v1/metrics
 @app.get("/api/v1/metrics")
 @app.head("/api/v1/metrics")  # added for https://stats.uptimerobot.com/EAWZfpoMkw
-async def get_metrics():
-    now = int(time.time())
-    uptimes = cur.execute(f"""
-        SELECT
-            type,
-            (1.0-1.0*SUM(duration)/({now}-MIN(start_time)))*100 AS total,
-            (1.0-1.0*SUM(CASE
-                WHEN start_time >= ({now}-(60*60*24*90)) THEN duration
-                WHEN start_time < ({now}-(60*60*24*90)) AND start_time+duration >= ({now}-(60*60*24*90)) THEN duration-({now}-(60*60*24*90)-start_time)
-                ELSE 0
-            END)/MIN((60*60*24*90), ({now}-MIN(start_time))))*100 AS ninety,
-            (1.0-1.0*SUM(CASE
-                WHEN start_time >= ({now}-(60*60*24*30)) THEN duration
-                WHEN start_time < ({now}-(60*60*24*30)) AND start_time+duration >= ({now}-(60*60*24*30)) THEN duration-({now}-(60*60*24*30)-start_time)
-                ELSE 0
-            END)/MIN((60*60*24*30), ({now}-MIN(start_time))))*100 AS thirty,
-            (1.0-1.0*SUM(CASE
-                WHEN start_time >= ({now}-(60*60*24*7)) THEN duration
-                WHEN start_time < ({now}-(60*60*24*7)) AND start_time+duration >= ({now}-(60*60*24*7)) THEN duration-({now}-(60*60*24*7)-start_time)
-                ELSE 0
-            END)/MIN((60*60*24*7), ({now}-MIN(start_time))))*100 AS seven,
-            (1.0-1.0*SUM(CASE
-                WHEN start_time >= ({now}-(60*60*24)) THEN duration
-                WHEN start_time < ({now}-(60*60*24)) AND start_time+duration >= ({now}-(60*60*24)) THEN duration-({now}-(60*60*24)-start_time)
-                ELSE 0
-            END)/MIN((60*60*24), ({now}-MIN(start_time))))*100 AS one
-        FROM
-            downtimes
-        GROUP BY
-            type
-    """).fetchall()
+def get_metrics():
+    cur = get_cursor()
+    with db_times.time("uptimes"):
+        uptimes = cur.execute(queries.uptimes, {"now": int(time.time())}).fetchall()
     ret = {
         "dashboard": "https://stats.uptimerobot.com/EAWZfpoMkw",
         "uptime": {},
@@ -691,6 +763,23 @@ async def get_metrics():
     return ret
 
 
+# http://localhost:443/api/v1/prometheus
+@app.get("/api/v1/prometheus")
+def get_prometheus_metrics():
+    # latency histograms and cache stats in the Prometheus text format - the UptimeRobot
+    # based numbers stay at /api/v1/metrics
+    return Response(content=metrics.render(), media_type="text/plain; version=0.0.4")
+
+
 if __name__ == "__main__":
     cwd = pathlib.Path(__file__).parent.resolve()
-    uvicorn.run(app, host="app", port=8000, log_config=f"{cwd}/log.ini")
+    host = os.environ.get("HOST", "app")
+    port = int(os.environ.get("PORT", 8000))
+    workers = int(os.environ.get("WORKERS", 1))
+    if workers > 1:
+        # building the indexes up front, so that the workers get to share them
+        refresh_generation_data()
+        metrics.shared_dir = tempfile.mkdtemp(prefix="meteo_metrics_")
+        serve_prefork(app, workers, host, port, f"{cwd}/log.ini")
+    else:
+        uvicorn.run(app, host=host, port=port, log_config=f"{cwd}/log.ini")
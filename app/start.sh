@@ -1,6 +1,7 @@
 cd /app
 
-if [ ! -f /data/meteo.db ]; then
+# also covers a db left behind by an older version, which lacks the newer tables
+if ! uv run utils/check_db.py; then
     sh run_job.sh download_small
 fi
 
@@ -0,0 +1,33 @@
+import os
+import sys
+import types
+import logging
+import tempfile
+
+# the download jobs import their modules from the utils folder directly (uv run utils/x.py)
+utils_folder = os.path.join(os.path.dirname(os.path.dirname(__file__)), "utils")
+sys.path.insert(0, utils_folder)
+
+# settings.py only exists in the image (copied from settings.example.py), and the jobs
+# read it at import time
+data_folder = f"{tempfile.mkdtemp(prefix='meteo_test_')}/"
+settings = types.ModuleType("settings")
+settings.data_folder = data_folder
+settings.data_uptimerobot_folder = data_folder
+settings.db_file = f"{data_folder}meteo.db"
+settings.run_emergency = f"{data_folder}run_emergency"
+settings.run_emergency_failed = f"{data_folder}run_emergency_failed"
+settings.update_failed = f"{data_folder}update_failed"
+settings.last_updated = f"{data_folder}last_updated"
+settings.generation_file = f"{data_folder}generation"
+settings.aurora_grid_file = f"{data_folder}ovation_aurora.grid"
+sys.modules["settings"] = settings
+
+# keeps the jobs' logging.basicConfig from opening /data/download.log
+logging.basicConfig(level=logging.INFO)
+
+# the server imports the same folder as a package (utils.x), which utils.py shadows here -
+# giving the module a __path__ lets both kinds of imports work in one test run
+import utils
+
+utils.__path__ = [utils_folder]
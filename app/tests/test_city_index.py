@@ -0,0 +1,55 @@
+import random
+
+from city_index import (
+    CityIndex,
+    get_cell_margin,
+    get_grid_cell,
+    grid_distance,
+    grid_step,
+    location_ranges,
+    max_lat,
+    max_lon,
+    min_lat,
+    min_lon,
+    resolve_cell,
+)
+
+
+def closest_city_id(index, lat, lon, types):
+    # what the server does without the grid
+    city = index.closest(lat, lon, types, distance=grid_distance)
+    if len(city) == 0:
+        city = index.closest(lat, lon, types)
+    return city[0]
+
+
+def test_grid_cells_match_the_index():
+    rng = random.Random(0)
+    index = CityIndex(
+        [
+            (
+                f"P{i}",
+                f"city {i}",
+                rng.uniform(min_lat, max_lat),
+                rng.uniform(min_lon, max_lon),
+                rng.choice(location_ranges["all"]),
+            )
+            for i in range(500)
+        ]
+    )
+    for types in location_ranges.values():
+        resolved = 0
+        for _ in range(5000):
+            lat = rng.uniform(min_lat, max_lat)
+            lon = rng.uniform(min_lon, max_lon)
+            lat_idx, lon_idx = get_grid_cell(lat, lon)
+            c_lat = min_lat + (lat_idx + 0.5) * grid_step
+            c_lon = min_lon + (lon_idx + 0.5) * grid_step
+            city_id = resolve_cell(
+                index, c_lat, c_lon, types, grid_distance, get_cell_margin(c_lat)
+            )
+            # unresolved cells get looked up in the index by the server
+            if city_id is not None:
+                assert city_id == closest_city_id(index, lat, lon, types)
+                resolved += 1
+        assert resolved > 4000
@@ -0,0 +1,257 @@
+# runs the download jobs against a throwaway data folder, with the LT API faked
+# uv run --with pytest pytest tests (from the app folder)
+import os
+import json
+import sqlite3
+import datetime
+
+import pytest
+import check_db
+import download_large
+import download_small
+from download_utils import forecast_s, table_conf, target_ds, warning_s
+from generation import next_generation
+from settings import (
+    data_folder,
+    db_file,
+    generation_file,
+    last_updated,
+    update_failed,
+)
+from utils import daily_params, hourly_params
+
+inputs = {
+    f"{forecast_s}/cities.csv": [
+        ["id", "name", "lat", "lon", "type", "county"],
+        ["P1", "Rīga", "56.95", "24.11", "republikas pilseta", "Rīga"],
+        ["P2", "Jūrmala", "56.97", "23.77", "republikas pilseta", "Jūrmala"],
+    ],
+    f"{forecast_s}/forcity_param.csv": [
+        ["id", "title_lv", "title_en"],
+        *[[str(p), f"p{p}", f"p{p}"] for p in hourly_params + daily_params],
+    ],
+    f"{forecast_s}/forecast_cities.csv": [
+        ["city_id", "param_id", "date", "value"],
+        *[
+            [c, str(p), f"2026-10-18 {h:02d}:00:00", "1"]
+            for c in ["P1", "P2"]
+            for p in hourly_params
+            for h in range(3)
+        ],
+    ],
+    f"{forecast_s}/forecast_cities_day.csv": [
+        ["city_id", "param_id", "date", "value"],
+        *[
+            [c, str(p), f"2026-10-{d} 00:00:00", "1"]
+            for c in ["P1", "P2"]
+            for p in daily_params
+            for d in range(18, 20)
+        ],
+    ],
+    f"{warning_s}/novadi.csv": [["id", "name_lv", "name_en"], ["1", "Rīga", "Riga"]],
+    f"{warning_s}/bridinajumu_novadi.csv": [["warning_id", "municipality_id"]],
+    f"{warning_s}/bridinajumu_poligoni.csv": [
+        ["warning_id", "polygon_id", "lat", "lon", "order_id"]
+    ],
+    f"{warning_s}/bridinajumu_metadata.csv": [
+        [
+            "number",
+            "id",
+            "intensity_lv",
+            "intensity_en",
+            "regions_lv",
+            "regions_en",
+            "type_lv",
+            "type_en",
+            "time_from",
+            "time_to",
+            "description_lv",
+            "description_en",
+        ]
+    ],
+}
+
+
+def write_inputs(files):
+    for fname, rows in files.items():
+        fpath = f"{data_folder}{fname}"
+        os.makedirs(os.path.dirname(fpath), exist_ok=True)
+        with open(fpath, "w", encoding="utf-8") as f:
+            f.write("".join([",".join(r) + "\n" for r in rows]))
+
+
+class FakeResponse:
+    def __init__(self, data):
+        self.status_code = 200
+        self.content = json.dumps(data).encode()
+
+    def json(self):
+        return json.loads(self.content)
+
+    def raise_for_status(self):
+        pass
+
+
+class FakeLTSession:
+    def __init__(self, *_):
+        pass
+
+    def get(self, url, **_):
+        return fake_lt_get(url)
+
+    def close(self):
+        pass
+
+
+def fake_lt_get(url):
+    if url.endswith("/places"):
+        return FakeResponse(
+            [
+                {
+                    "code": "vilnius",
+                    "name": "Vilnius",
+                    "administrativeDivision": "Vilniaus miesto savivaldybė",
+                    "countryCode": "LT",
+                    "coordinates": {"latitude": 54.69, "longitude": 25.28},
+                }
+            ]
+        )
+    start = datetime.datetime(2026, 10, 18)
+    return FakeResponse(
+        {
+            "forecastTimestamps": [
+                {
+                    "forecastTimeUtc": (start + datetime.timedelta(hours=h)).strftime(
+                        "%Y-%m-%d %H:%M:%S"
+                    ),
+                    "airTemperature": 5.0,
+                    "feelsLikeTemperature": 3.0,
+                    "windSpeed": 2,
+                    "windGust": 4,
+                    "windDirection": 180,
+                    "totalPrecipitation": 0,
+                    "conditionCode": "cloudy",
+                }
+                for h in range(72)
+            ]
+        }
+    )
+
+
+@pytest.fixture(autouse=True)
+def empty_data_folder():
+    for fpath in [db_file, generation_file, last_updated, update_failed]:
+        if os.path.isfile(fpath):
+            os.remove(fpath)
+    write_inputs(inputs)
+
+
+def run_small(update_time):
+    with next_generation(update_time) as db_fpath:
+        download_small.update_db(
+            update_time,
+            db_fpath,
+            {t["table_name"]: download_small.get_inputs_hash(t) for t in table_conf},
+        )
+
+
+def city_counts():
+    con = sqlite3.connect(db_file)
+    try:
+        return dict(
+            con.execute(
+                "SELECT source, COUNT(*) FROM cities GROUP BY source"
+            ).fetchall()
+        )
+    finally:
+        con.close()
+
+
+def test_lt_download_keeps_unchanged_lv_cities(monkeypatch):
+    monkeypatch.setattr(download_large, "create_session", FakeLTSession)
+    monkeypatch.setattr(download_large, "sleep", lambda _: None)
+
+    run_small("202610180000")
+    assert city_counts() == {"LV": 2}
+    download_large.do_4_h_download("202610180010")
+    assert city_counts() == {"LV": 2, "LT": 1}
+    # cities.csv hasn't changed, so the LV cities don't get ingested (or touched) again
+    run_small("202610180020")
+    assert city_counts() == {"LV": 2, "LT": 1}
+    download_large.do_4_h_download("202610180030")
+    assert city_counts() == {"LV": 2, "LT": 1}
+
+
+def test_failed_table_keeps_its_previous_rows(monkeypatch):
+    monkeypatch.delenv("UPTIMEROBOT", raising=False)
+    monkeypatch.setattr(download_small, "download_resources", lambda *_: False)
+    with open(f"{data_folder}{target_ds[0]}.json", "w") as f:
+        f.write("{}")
+
+    download_small.do_20_m_download(target_ds, "202610180000")
+    forecasts = inputs[f"{forecast_s}/forecast_cities.csv"]
+    write_inputs(
+        {
+            f"{forecast_s}/cities.csv": [
+                *inputs[f"{forecast_s}/cities.csv"],
+                ["P3", "Broken", "not a number", "24.11", "pilseta", "Rīga"],
+            ],
+            f"{forecast_s}/forecast_cities.csv": [
+                forecasts[0],
+                *[[*r[:3], "2"] for r in forecasts[1:]],
+            ],
+        }
+    )
+    download_small.do_20_m_download(target_ds, "202610180020")
+    # the forecasts still get published, the cities stay as they were
+    assert city_counts() == {"LV": 2}
+    con = sqlite3.connect(db_file)
+    try:
+        assert con.execute("SELECT MAX(value) FROM forecast_cities").fetchone() == (2,)
+    finally:
+        con.close()
+    with open(generation_file) as f:
+        assert f.read() == "202610180020"
+    with open(update_failed) as f:
+        assert f.read() == "202610180020 cities"
+
+    write_inputs({f"{forecast_s}/cities.csv": inputs[f"{forecast_s}/cities.csv"]})
+    download_small.do_20_m_download(target_ds, "202610180040")
+    assert not os.path.isfile(update_failed)
+
+
+def test_uptimerobot_failure_still_publishes(monkeypatch):
+    def post(*_, **__):
+        raise download_small.requests.ConnectionError("unreachable")
+
+    monkeypatch.setenv("UPTIMEROBOT", "key")
+    monkeypatch.setattr(download_small.requests, "post", post)
+    monkeypatch.setattr(download_small, "download_resources", lambda *_: False)
+    with open(f"{data_folder}{target_ds[0]}.json", "w") as f:
+        f.write("{}")
+
+    download_small.do_20_m_download(target_ds, "202610180000")
+    assert city_counts() == {"LV": 2}
+    with open(generation_file) as f:
+        assert f.read() == "202610180000"
+    assert os.path.isfile(last_updated)
+
+
+def test_unchanged_inputs_skip_the_generation(monkeypatch):
+    monkeypatch.delenv("UPTIMEROBOT", raising=False)
+    monkeypatch.setattr(download_small, "download_resources", lambda *_: False)
+    with open(f"{data_folder}{target_ds[0]}.json", "w") as f:
+        f.write("{}")
+
+    download_small.do_20_m_download(target_ds, "202610180000")
+    db_mtime = os.path.getmtime(db_file)
+    download_small.do_20_m_download(target_ds, "202610180020")
+    assert os.path.getmtime(db_file) == db_mtime
+    with open(generation_file) as f:
+        assert f.read() == "202610180000"
+
+
+def test_download_creates_the_tables_the_server_reads():
+    assert len(check_db.get_missing_tables()) > 0
+    run_small("202610180000")
+    assert check_db.get_missing_tables() == []
@@ -0,0 +1,71 @@
+import random
+import string
+
+from utils.name_index import NameIndex, editdist, max_cost
+
+syllables = ["ka", "la", "ri", "ga", "ve", "ce", "dzi", "kal", "ber", "mui", "za"]
+syllables += ["ciem", "pa", "ta", "sa", "un", "gul", "va", "dau", "vil", "pils", "ezer"]
+suffixes = ["", "s", "i", "a", "ciems", "muiza", " ciems"]
+types = ("pilsēta", "ciems", "cits")
+
+
+def create_index(rng):
+    names = set()
+    while len(names) < 1500:
+        names.add(
+            "".join(rng.choice(syllables) for _ in range(rng.randint(1, 4)))
+            + rng.choice(suffixes)
+        )
+    return NameIndex(
+        [
+            (f"P{i}", n, 56.95, 24.11, rng.choice(types), n)
+            for i, n in enumerate(sorted(names))
+        ]
+    )
+
+
+def closest_brute_force(index, search_name):
+    allowed = index.get_allowed(types)
+    query = search_name.encode("ascii", "replace")
+    dist = {i: editdist(index.encoded[i], query) for i in allowed}
+    best = min(dist.values())
+    best_i = min(
+        [i for i, d in dist.items() if d == best], key=lambda i: allowed[i][:2]
+    )
+    return (*allowed[best_i][3], best)
+
+
+def add_typos(rng, name):
+    name = list(name)
+    for _ in range(rng.randint(1, 3)):
+        pos = rng.randrange(len(name))
+        op = rng.choice(["insert", "delete", "replace"])
+        if op == "insert":
+            name.insert(pos, rng.choice(string.ascii_lowercase))
+        elif op == "delete" and len(name) > 1:
+            del name[pos]
+        else:
+            name[pos] = rng.choice(string.ascii_lowercase)
+    return "".join(name)
+
+
+def test_search_matches_brute_force():
+    rng = random.Random(0)
+    index = create_index(rng)
+    searches = [add_typos(rng, rng.choice(index.names)) for _ in range(60)]
+    searches += [rng.choice(index.names) for _ in range(10)]
+    for search_name in searches:
+        expected = closest_brute_force(index, search_name)
+        if expected[-1] <= max_cost:
+            assert index.closest(search_name, types) == expected, search_name
+
+
+def test_far_off_search_returns_a_candidate():
+    rng = random.Random(0)
+    index = create_index(rng)
+    search_name = "".join(rng.choice(string.ascii_lowercase) for _ in range(64))
+    found = index.closest(search_name, types)
+    assert found[-1] > max_cost
+    assert found[-1] == editdist(
+        index.encoded[index.names.index(found[1])], search_name.encode()
+    )
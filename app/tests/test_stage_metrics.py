@@ -0,0 +1,47 @@
+import os
+import json
+
+from utils.stage_metrics import StageMetrics
+
+dead_pid = 2**22 + 1  # above the default pid_max
+
+
+def create_metrics(shared_dir):
+    metrics = StageMetrics()
+    metrics.shared_dir = str(shared_dir)
+    stage_times = metrics.histogram("stage_seconds", "Stage times", "stage")
+    metrics.add_collector(
+        lambda: [("hits_total", "counter", "Hits", 3), ("size", "gauge", "Size", 5)]
+    )
+    return metrics, stage_times
+
+
+def test_workers_get_added_up(tmp_path):
+    metrics, stage_times = create_metrics(tmp_path)
+    stage_times.get("query").observe(0.002)
+
+    # another worker that has exited since
+    other, other_times = create_metrics(tmp_path)
+    other_times.get("query").observe(0.002)
+    other_times.get("query").observe(0.3)
+    snapshot = other.snapshot()
+    snapshot["pid"] = dead_pid
+    with open(os.path.join(tmp_path, f"{dead_pid}.json"), "w") as f:
+        json.dump(snapshot, f)
+
+    lines = metrics.render().splitlines()
+    assert 'stage_seconds_bucket{stage="query",le="0.0025"} 2' in lines
+    assert 'stage_seconds_bucket{stage="query",le="+Inf"} 3' in lines
+    assert 'stage_seconds_count{stage="query"} 3' in lines
+    # counters keep what the exited worker counted, gauges only cover live workers
+    assert "hits_total 6" in lines
+    assert "size 5" in lines
+
+
+def test_single_worker_needs_no_shared_dir():
+    metrics, stage_times = create_metrics(None)
+    metrics.shared_dir = None
+    stage_times.get("query").observe(0.002)
+    lines = metrics.render().splitlines()
+    assert 'stage_seconds_count{stage="query"} 1' in lines
+    assert "hits_total 3" in lines
@@ -0,0 +1,59 @@
+import os
+import mmap
+import struct
+
+# NOAA ovation grid stored as a single byte per cell, lon (0..359) major and
+# lat (-90..90) minor, after a header holding the forecast time (unix seconds)
+header = struct.Struct("<4sHq")
+magic = b"AURG"
+version = 1
+lon_count = 360
+lat_count = 181
+grid_size = lon_count * lat_count
+
+
+def get_cell(lat, lon):
+    return (lon % lon_count) * lat_count + (lat + 90)
+
+
+def write_grid(fpath, forecast_time, coordinates):
+    # coordinates - [lon, lat, aurora] triplets, as served by NOAA
+    grid = bytearray(grid_size)
+    for lon, lat, aurora in coordinates:
+        grid[get_cell(int(lat), int(lon))] = max(0, min(255, int(aurora)))
+    # writing to a temporary file and renaming it, so that the server either maps the old
+    # grid or the new one, never a partially written one
+    tmp_fpath = f"{fpath}.tmp"
+    with open(tmp_fpath, "wb") as f:
+        f.write(header.pack(magic, version, forecast_time))
+        f.write(grid)
+    os.replace(tmp_fpath, fpath)
+
+
+def read_forecast_time(fpath):
+    try:
+        with open(fpath, "rb") as f:
+            f_magic, f_version, forecast_time = header.unpack(f.read(header.size))
+    except (FileNotFoundError, struct.error):
+        return None
+    if f_magic != magic or f_version != version:
+        return None
+    return forecast_time
+
+
+class AuroraGrid:
+    def __init__(self, fpath):
+        with open(fpath, "rb") as f:
+            self.grid = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        f_magic, f_version, self.forecast_time = header.unpack_from(self.grid, 0)
+        if (
+            f_magic != magic
+            or f_version != version
+            or len(self.grid) != header.size + grid_size
+        ):
+            raise ValueError(f"{fpath} is not a valid aurora grid")
+
+    def get(self, lat, lon):
+        if not -90 <= lat <= 90:
+            return 0
+        return self.grid[header.size + get_cell(lat, lon)]
@@ -0,0 +1,135 @@
+# compares the forecast_cities cleanup that runs after every ingest the way it used to be
+# (MIN/MAX over rows with the current update_time) against the staging table based one,
+# and what a (param_id, date) index would cost the inserts that come before the cleanup
+# uv run python -m utils.benchmark_cleanup (from the app folder)
+import os
+import random
+import shutil
+import sqlite3
+import tempfile
+import time
+
+from utils.forecast_cleanup import cleanup_forecasts
+from utils.utils import daily_params, hourly_params
+
+city_count = 1500
+hourly_dates = 60
+daily_dates = 10
+
+
+def create_db(db_file):
+    # one download's worth of forecasts, plus the dates that the previous download had
+    # and this one doesn't (the first hour and the first day), which cleanup removes
+    con = sqlite3.connect(db_file)
+    cur = con.cursor()
+    rng = random.Random(0)
+    cur.execute("""
+        CREATE TABLE forecast_cities (
+            city_id TEXT,
+            param_id INTEGER,
+            date INTEGER,
+            value REAL,
+            update_time INTEGER,
+            PRIMARY KEY (city_id, param_id, date)
+        )
+    """)
+    cur.execute(
+        "CREATE TABLE staging_forecast_cities (city_id TEXT, param_id INTEGER, date INTEGER, value REAL)"
+    )
+    for params, dates in [
+        (hourly_params, [202501010000 + d * 100 for d in range(hourly_dates)]),
+        (daily_params, [202501010000 + d * 10000 for d in range(daily_dates)]),
+    ]:
+        rows = [
+            (f"C{c}", p, date, rng.uniform(-10, 30), 1 if i == 0 else 2)
+            for c in range(city_count)
+            for p in params
+            for i, date in enumerate(dates)
+        ]
+        cur.executemany("INSERT INTO forecast_cities VALUES (?, ?, ?, ?, ?)", rows)
+        cur.executemany(
+            "INSERT INTO staging_forecast_cities VALUES (?, ?, ?, ?)",
+            [r[:4] for r in rows if r[4] == 2],
+        )
+    con.commit()
+    con.close()
+
+
+def cleanup_old(cur):
+    not_params = (
+        f"param_id NOT IN ({','.join([str(p) for p in hourly_params + daily_params])})"
+    )
+    h_where = f"param_id IN ({','.join([str(p) for p in hourly_params])})"
+    d_where = f"param_id IN ({','.join([str(p) for p in daily_params])})"
+    h_valid_dates = cur.execute(
+        f"SELECT MIN(date), MAX(date) FROM forecast_cities WHERE update_time = ? AND {h_where}",
+        [2],
+    ).fetchall()
+    d_valid_dates = cur.execute(
+        f"SELECT MIN(date), MAX(date) FROM forecast_cities WHERE update_time = ? AND {d_where}",
+        [2],
+    ).fetchall()
+    cur.execute(
+        f"""
+        DELETE FROM forecast_cities
+        WHERE
+            ((date < :h_min OR date > :h_max) AND {h_where}) OR
+            ((date < :d_min OR date > :d_max) AND {d_where}) OR
+            {not_params} OR param_id IS NULL
+    """,
+        {
+            "h_min": h_valid_dates[0][0],
+            "h_max": h_valid_dates[0][1],
+            "d_min": d_valid_dates[0][0],
+            "d_max": d_valid_dates[0][1],
+        },
+    )
+    return cur.rowcount
+
+
+def cleanup_new(cur):
+    return cleanup_forecasts(
+        cur, "forecast_cities", "staging_forecast_cities", hourly_params, daily_params
+    )
+
+
+def insert(cur):
+    # a new row for every staged one - updates that only change the value don't touch
+    # the index, inserts (new dates coming into the forecast) do
+    cur.execute("""
+        INSERT INTO forecast_cities (city_id, param_id, date, value, update_time)
+        SELECT city_id, param_id, date + 1, value, 3 FROM staging_forecast_cities
+    """)
+    return cur.rowcount
+
+
+def timed(db_file, f, index=False):
+    con = sqlite3.connect(db_file)
+    cur = con.cursor()
+    if index:
+        cur.execute(
+            "CREATE INDEX forecast_cities_param_id_date_idx ON forecast_cities (param_id, date)"
+        )
+        con.commit()
+    start = time.perf_counter()
+    rows = f(cur)
+    con.commit()
+    elapsed = time.perf_counter() - start
+    con.close()
+    return elapsed, rows
+
+
+if __name__ == "__main__":
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        template_file = os.path.join(tmp_dir, "template.db")
+        create_db(template_file)
+        for name, f, index in [
+            ("cleanup old", cleanup_old, False),
+            ("cleanup new", cleanup_new, False),
+            ("insert", insert, False),
+            ("insert indexed", insert, True),
+        ]:
+            db_file = os.path.join(tmp_dir, f"{name}.db")
+            shutil.copy(template_file, db_file)
+            elapsed, rows = timed(db_file, f, index)
+            print(f"{name:>14}: {elapsed:.3f} s ({rows} rows)")
@@ -0,0 +1,55 @@
+# times city name searches against a synthetic index about the size of the real one -
+# typical names and typos, and the worst case (long input that's nowhere near any name)
+# uv run python -m utils.benchmark_name_index (from the app folder)
+import random
+import string
+import time
+
+from utils.name_index import NameIndex
+
+name_count = 9000
+syllables = [
+    *["ka", "la", "ma", "ri", "ga", "ve", "ce", "lu", "dzi", "ne", "kal", "ber", "zi"],
+    *["mui", "za", "ro", "pa", "ta", "ku", "li", "sa", "ja", "un", "ciem", "gul", "be"],
+    *["va", "le", "ra", "to", "ba", "dau", "vil", "pils", "sal", "tal", "sil", "ezer"],
+]
+suffixes = ["", "s", "i", "a", "e", "ciems", "muiza", "kalns", " ciems", "ji", "ki"]
+types = ("pilsēta", "ciems", "cits")
+
+
+def create_index(rng):
+    names = {"riga"}
+    while len(names) < name_count:
+        names.add(
+            "".join(rng.choice(syllables) for _ in range(rng.randint(1, 4)))
+            + rng.choice(suffixes)
+        )
+    return NameIndex(
+        [(f"P{i}", n, 56.95, 24.11, "ciems", n) for i, n in enumerate(sorted(names))]
+    )
+
+
+def run(index, query):
+    # _find, so that the lru_cache doesn't get in the way
+    start = time.perf_counter()
+    result = index._find(query, types)
+    return (time.perf_counter() - start) * 1000, result
+
+
+if __name__ == "__main__":
+    rng = random.Random(0)
+    index = create_index(rng)
+    garbage = lambda n: "".join(rng.choice(string.ascii_lowercase) for _ in range(n))
+    for query in [
+        "riga",
+        "rigaa",
+        "kalnciems",
+        "kalncems",
+        garbage(19),
+        garbage(30),
+        garbage(64),
+        "kalnciems" * 7,
+    ]:
+        ms, result = run(index, query)
+        match = f"{result[1]} ({result[-1]})" if len(result) > 0 else "-"
+        print(f"{query[:30]:>30}: {ms:8.1f} ms -> {match}")
@@ -0,0 +1,130 @@
+# compares running the server's queries with values inlined into the sql text (the way
+# they used to be built) against running them with bound parameters
+# uv run python -m utils.benchmark_queries (from the app folder)
+import os
+import re
+import random
+import sqlite3
+import tempfile
+import time
+
+from utils import queries
+from utils.utils import daily_params, hourly_params
+
+city_count = 3000
+request_count = 5000
+
+
+def create_db(db_file):
+    con = sqlite3.connect(db_file)
+    cur = con.cursor()
+    rng = random.Random(0)
+    cities = [
+        (f"C{i}", rng.uniform(55.7, 58.05), rng.uniform(20.95, 28.25))
+        for i in range(city_count)
+    ]
+    for table_name, params, step in [
+        ("forecast_cities_hourly", hourly_params, 100),
+        ("forecast_cities_daily", daily_params, 600),
+    ]:
+        cur.execute(f"""
+            CREATE TABLE {table_name} (
+                city_id TEXT,
+                date INTEGER,
+                time INTEGER,
+                {", ".join([f"val_{p}" for p in params])},
+                update_time INTEGER,
+                PRIMARY KEY (city_id, date)
+            ) WITHOUT ROWID
+        """)
+        cur.executemany(
+            f"INSERT INTO {table_name} VALUES ({', '.join(['?'] * (len(params) + 4))})",
+            [
+                (c[0], 202501010000 + d * step, 202501010000 + d * step)
+                + tuple(rng.randint(0, 100) for _ in params)
+                + (0,)
+                for c in cities
+                for d in range(24)
+            ],
+        )
+    cur.execute("""
+        CREATE TABLE active_warnings (
+            id INTEGER, intensity_val INTEGER, intensity_lv TEXT, intensity_en TEXT,
+            regions_lv TEXT, regions_en TEXT, type_lv TEXT, type_en TEXT,
+            time_from INTEGER, time_to INTEGER, description_lv TEXT, description_en TEXT
+        )
+    """)
+    cur.execute("""
+        CREATE TABLE city_warnings (
+            city_id TEXT, warning_id INTEGER, PRIMARY KEY (city_id, warning_id)
+        ) WITHOUT ROWID
+    """)
+    for i in range(20):
+        cur.execute(
+            "INSERT INTO active_warnings VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (
+                i,
+                1,
+                "Dzeltens",
+                "Yellow",
+                "",
+                "",
+                "Vējš",
+                "Wind",
+                0,
+                209901010000,
+                "",
+                "",
+            ),
+        )
+    cur.execute("CREATE INDEX active_warnings_id_idx ON active_warnings (id)")
+    cur.executemany(
+        "INSERT INTO city_warnings VALUES (?, ?)",
+        [(c[0], rng.randint(0, 19)) for c in cities if rng.random() < 0.2],
+    )
+    con.commit()
+    con.close()
+    return cities
+
+
+def inline(query, params):
+    # puts the values straight into the sql text, so every request gets a statement of its own
+    return re.sub(
+        r":(\w+)",
+        lambda m: (
+            repr(params[m.group(1)])
+            if isinstance(params[m.group(1)], str)
+            else str(params[m.group(1)])
+        ),
+        query,
+    )
+
+
+def run(cur, cities, build):
+    rng = random.Random(1)
+    start = time.perf_counter()
+    for _ in range(request_count):
+        city = rng.choice(cities)
+        c_date = 202501010000 + rng.randint(0, 23) * 100
+        city_ids = f'["{city[0]}"]'
+        for query, params in [
+            (queries.forecast_hourly, {"city_ids": city_ids, "c_date": c_date}),
+            (queries.forecast_daily, {"city_ids": city_ids, "c_date": c_date}),
+            (queries.simple_warnings, {"city_id": city[0], "c_date": c_date}),
+        ]:
+            cur.execute(*build(query, params)).fetchall()
+    return (time.perf_counter() - start) / request_count * 1000
+
+
+if __name__ == "__main__":
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        db_file = os.path.join(tmp_dir, "benchmark.db")
+        cities = create_db(db_file)
+        for name, build in [
+            ("inlined", lambda q, p: (inline(q, p),)),
+            ("bound", lambda q, p: (q, p)),
+        ]:
+            con = sqlite3.connect(db_file)
+            ms = run(con.cursor(), cities, build)
+            con.close()
+            print(f"{name:>8}: {ms:.3f} ms per request ({request_count} requests)")
@@ -0,0 +1,143 @@
+import time
+import logging
+import sqlite3
+import itertools
+
+
+def connect(db_fpath):
+    # jobs only ever write to a private copy of the db, which gets synced and published
+    # once it's complete (see generation.py) - there's nothing to protect until then
+    con = sqlite3.connect(db_fpath)
+    con.execute("PRAGMA synchronous=OFF")
+    con.execute("PRAGMA journal_mode=MEMORY")  # still there for rollbacks
+    con.execute("PRAGMA cache_size=-65536")  # KiB
+    return con
+
+
+class BulkWriter:
+    # rows get loaded into a temp staging table and then merged into the target table
+    # with a single INSERT ... SELECT - staging, merging and cleanup all happen in one
+    # transaction, so the table is never seen half updated
+    # dedupe - duplicate primary keys get merged by taking the max of every column
+    # changed_only - existing rows only get written if their values have changed, so
+    #   update_time becomes the time of the last change
+    def __init__(
+        self,
+        db_con,
+        table_name,
+        cols,
+        pks,
+        update_time,
+        dedupe=False,
+        changed_only=False,
+        batch_size=10000,
+    ):
+        self.db_con = db_con
+        self.cur = db_con.cursor()
+        self.table_name = table_name
+        self.cols = cols
+        self.pks = pks
+        self.update_time = update_time
+        self.dedupe = dedupe and len(pks) > 0
+        self.changed_only = changed_only
+        self.batch_size = batch_size
+        self.staging_table = f"temp.staging_{table_name}"
+        self.staged = 0
+        self.merged = 0
+        self.deleted = 0
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        self.db_con.commit()
+        self.cur.execute("BEGIN")
+        self.cur.execute(f"DROP TABLE IF EXISTS {self.staging_table}")
+        # untyped columns, values keep the types they were parsed into until the merge
+        self.cur.execute(f"CREATE TABLE {self.staging_table} ({', '.join(self.cols)})")
+        return self
+
+    def add(self, rows):
+        # rows - any iterable, gets consumed in batches
+        rows = iter(rows)
+        batch = list(itertools.islice(rows, self.batch_size))
+        while len(batch) > 0:
+            self.cur.executemany(
+                f"""
+                INSERT INTO {self.staging_table} ({", ".join(self.cols)})
+                VALUES ({", ".join(["?"] * len(self.cols))})
+            """,
+                batch,
+            )
+            self.staged += len(batch)
+            batch = list(itertools.islice(rows, self.batch_size))
+
+    def merge(self):
+        non_pks = [c for c in self.cols if c not in self.pks]
+        upsert_q = ""
+        if len(self.pks) > 0:
+            changed_q = ""
+            if self.changed_only and len(non_pks) > 0:
+                changed_q = f"WHERE {' OR '.join([f'{c} IS NOT excluded.{c}' for c in non_pks])}"
+            update_q = [f"{c}=excluded.{c}" for c in non_pks]
+            upsert_q = f"""
+                ON CONFLICT({", ".join(self.pks)}) DO UPDATE SET
+                    {", ".join(update_q + ["update_time=excluded.update_time"])}
+                {changed_q}
+            """
+        select_q = (
+            [c if c in self.pks else f"MAX({c})" for c in self.cols]
+            if self.dedupe
+            else self.cols
+        )
+        group_q = f"GROUP BY {', '.join(self.pks)}" if self.dedupe else ""
+        # WHERE true - without it sqlite would read the ON of ON CONFLICT as a join
+        self.cur.execute(
+            f"""
+            INSERT INTO {self.table_name} ({", ".join(self.cols)}, update_time)
+            SELECT
+                {", ".join(select_q)}, ?
+            FROM
+                {self.staging_table}
+            WHERE
+                true
+            {group_q}
+            {upsert_q}
+        """,
+            [self.update_time],
+        )
+        # rowcount covers both inserts and updates, unchanged rows aren't counted
+        self.merged = self.cur.rowcount
+        if self.changed_only:
+            logging.info(
+                f"TABLE '{self.table_name}' - {self.merged} rows inserted or changed ({self.staged} rows staged)"
+            )
+        else:
+            logging.info(
+                f"TABLE '{self.table_name}' - {self.merged} rows upserted ({self.staged} rows staged)"
+            )
+        return self.merged
+
+    def cleanup(self, query, params=()):
+        start = time.perf_counter()
+        self.cur.execute(query, params)
+        self.add_deleted(self.cur.rowcount, time.perf_counter() - start)
+        return self.cur.rowcount
+
+    def add_deleted(self, count, elapsed):
+        # for cleanups that take more than one statement
+        self.deleted += count
+        logging.info(
+            f"TABLE '{self.table_name}' - {count} old rows deleted ({elapsed:.3f} s)"
+        )
+
+    def __exit__(self, exc_type, *_):
+        if exc_type is not None:
+            self.db_con.rollback()
+            self.cur.execute(f"DROP TABLE IF EXISTS {self.staging_table}")
+            return False
+        self.cur.execute(f"DROP TABLE {self.staging_table}")
+        self.db_con.commit()
+        elapsed = time.perf_counter() - self.start
+        logging.info(
+            f"TABLE '{self.table_name}' - {self.staged} rows staged, {self.merged} merged, {self.deleted} deleted in {elapsed:.2f} s ({self.staged / elapsed if elapsed > 0 else 0:.0f} rows/s)"
+        )
+        return False
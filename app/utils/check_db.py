@@ -0,0 +1,39 @@
+# exits with 1 if the db is missing or doesn't have the tables that the server reads -
+# /data outlives deploys, so the db can have been built by an older version of the jobs.
+# start.sh runs download_small then, which rebuilds every table without a table_state entry
+import sys
+import sqlite3
+
+from settings import db_file
+
+required_tables = [
+    "table_state",
+    "forecast_cities_hourly",
+    "forecast_cities_daily",
+    "city_warnings",
+    "active_warnings",
+]
+
+
+def get_missing_tables():
+    try:
+        db_con = sqlite3.connect(f"file:{db_file}?mode=ro", uri=True)
+    except sqlite3.OperationalError:  # no db at all
+        return required_tables
+    try:
+        tables = {
+            t[0]
+            for t in db_con.execute(
+                "SELECT name FROM sqlite_master WHERE type = 'table'"
+            ).fetchall()
+        }
+    finally:
+        db_con.close()
+    return [t for t in required_tables if t not in tables]
+
+
+if __name__ == "__main__":
+    missing_tables = get_missing_tables()
+    if len(missing_tables) > 0:
+        print(f"DB is missing tables: {', '.join(missing_tables)}")
+        sys.exit(1)
@@ -0,0 +1,261 @@
+import math
+from array import array
+
+EARTH_RADIUS = 6371  # km
+
+# the old SQL CASE statement matched 'pilseta' (without the macron), meaning that cities
+# ended up with a NULL ctype, and NULLs sort first in SQLite - keeping that ordering
+ctypes = {
+    "pilsēta": None,
+    "ciems": 2,
+    "cits": 3,
+    "location_LT": 4,
+}
+
+location_ranges = {
+    "all": ("pilsēta", "ciems", "cits", "location_LT"),
+    "emergency": ("pilsēta", "location_LT"),
+}
+
+
+def ctype_rank(ctype):
+    return 0 if ctype is None else ctype
+
+
+def to_xyz(lat, lon):
+    r_lat = math.radians(lat)
+    r_lon = math.radians(lon)
+    return (
+        math.cos(r_lat) * math.cos(r_lon),
+        math.cos(r_lat) * math.sin(r_lon),
+        math.sin(r_lat),
+    )
+
+
+def distance_to_chord(distance):
+    # straight line distance through the unit sphere - grows monotonically with the
+    # great circle distance, so the closest point by one is the closest by the other
+    return 2 * math.sin(distance / (2 * EARTH_RADIUS))
+
+
+def chord_to_distance(chord):
+    return 2 * EARTH_RADIUS * math.asin(min(1.0, chord / 2))
+
+
+def get_distance(lat_a, lon_a, lat_b, lon_b):
+    # spherical law of cosines, same as the old SQL query (clamping since
+    # float errors can push identical points slightly above 1)
+    r_lat_a = math.radians(lat_a)
+    r_lat_b = math.radians(lat_b)
+    return (
+        math.acos(
+            max(
+                -1.0,
+                min(
+                    1.0,
+                    math.sin(r_lat_a) * math.sin(r_lat_b)
+                    + math.cos(r_lat_a)
+                    * math.cos(r_lat_b)
+                    * math.cos(math.radians(lon_b) - math.radians(lon_a)),
+                ),
+            )
+        )
+        * EARTH_RADIUS
+    )
+
+
+class KDTree:
+    # a static 3d tree stored in flat arrays - the node for the [lo, hi) range always
+    # sits in the middle of the range, so no child pointers are needed
+    def __init__(self, points):
+        # points - list of (lat, lon, payload)
+        nodes = [(*to_xyz(p[0], p[1]), i) for i, p in enumerate(points)]
+        self.payload = [p[2] for p in points]
+        self.coords = array("d", [0.0] * (3 * len(nodes)))
+        self.ids = array("l", [0] * len(nodes))
+        self.axes = array("b", [0] * len(nodes))
+        self._build(nodes, 0, len(nodes))
+
+    def __len__(self):
+        return len(self.ids)
+
+    def _build(self, nodes, lo, hi):
+        if lo >= hi:
+            return
+        part = nodes[lo:hi]
+        # splitting along the axis with the largest spread
+        axis = max(
+            range(3), key=lambda a: max(n[a] for n in part) - min(n[a] for n in part)
+        )
+        part.sort(key=lambda n: n[axis])
+        nodes[lo:hi] = part
+        mid = (lo + hi) // 2
+        self.coords[3 * mid : 3 * mid + 3] = array("d", nodes[mid][:3])
+        self.ids[mid] = nodes[mid][3]
+        self.axes[mid] = axis
+        self._build(nodes, lo, mid)
+        self._build(nodes, mid + 1, hi)
+
+    def nearest(self, lat, lon, max_chord=2.0, skip=None):
+        # returns (squared chord distance, payload) for the closest point within max_chord
+        q = to_xyz(lat, lon)
+        best = [max_chord * max_chord * (1 + 1e-9), -1]
+        coords, ids, axes = self.coords, self.ids, self.axes
+        payload = self.payload
+
+        def visit(lo, hi):
+            if lo >= hi:
+                return
+            mid = (lo + hi) // 2
+            c = 3 * mid
+            dx = q[0] - coords[c]
+            dy = q[1] - coords[c + 1]
+            dz = q[2] - coords[c + 2]
+            d2 = dx * dx + dy * dy + dz * dz
+            if d2 < best[0] and (skip is None or payload[ids[mid]][0] not in skip):
+                best[0] = d2
+                best[1] = ids[mid]
+            diff = q[axes[mid]] - coords[c + axes[mid]]
+            if diff < 0:
+                visit(lo, mid)
+                if diff * diff < best[0]:
+                    visit(mid + 1, hi)
+            else:
+                visit(mid + 1, hi)
+                if diff * diff < best[0]:
+                    visit(lo, mid)
+
+        visit(0, len(ids))
+        if best[1] < 0:
+            return None
+        return best[0], payload[best[1]]
+
+
+class CityIndex:
+    # one tree per location type, so that the ctype-then-distance ordering can be
+    # resolved by checking the trees in ctype order
+    def __init__(self, cities):
+        # cities - rows of (id, name, lat, lon, type)
+        by_type = {}
+        self.cities = {}
+        for c in cities:
+            city = (c[0], c[1], c[2], c[3], ctypes.get(c[4]))
+            self.cities[c[0]] = city
+            by_type.setdefault(c[4], []).append((c[2], c[3], city))
+        self.trees = {t: KDTree(v) for t, v in by_type.items()}
+
+    def __len__(self):
+        return len(self.cities)
+
+    def with_distance(self, city, lat, lon):
+        return (*city, get_distance(city[2], city[3], lat, lon))
+
+    def get_by_id(self, city_id, lat, lon):
+        city = self.cities.get(city_id)
+        return () if city is None else self.with_distance(city, lat, lon)
+
+    def closest(self, lat, lon, types, distance=None, skip=None):
+        # distance=None - closest city regardless of type, otherwise the closest city
+        # of the highest priority type that has anything within the radius
+        trees = [(t, self.trees[t]) for t in types if t in self.trees]
+        if distance is None:
+            found = [tree.nearest(lat, lon, skip=skip) for _, tree in trees]
+            found = [f for f in found if f is not None]
+            if len(found) == 0:
+                return ()
+            return self.with_distance(min(found, key=lambda f: f[0])[1], lat, lon)
+
+        max_chord = distance_to_chord(distance)
+        for _, tree in sorted(trees, key=lambda t: ctype_rank(ctypes.get(t[0]))):
+            found = tree.nearest(lat, lon, max_chord=max_chord, skip=skip)
+            if found is not None:
+                return self.with_distance(found[1], lat, lon)
+        return ()
+
+
+# most requests come from within these bounds - nearest cities in here get precomputed
+# into a grid of grid_step sized cells, anything outside falls back to the index
+min_lat, max_lat = 55.7, 58.05
+min_lon, max_lon = 20.95, 28.25
+grid_step = 0.005
+grid_distance = 7  # km
+grid_lat_cells = round((max_lat - min_lat) / grid_step) + 1
+grid_lon_cells = round((max_lon - min_lon) / grid_step) + 1
+# part of the cities hash that decides whether the grid gets rebuilt - bumped whenever
+# build_city_grid starts returning something different for the same cities
+grid_version = 2
+
+
+def is_in_bounds(lat, lon):
+    return min_lat <= lat <= max_lat and min_lon <= lon <= max_lon
+
+
+def get_grid_cell(lat, lon):
+    return (
+        math.floor((lat - min_lat) / grid_step),
+        math.floor((lon - min_lon) / grid_step),
+    )
+
+
+def get_cell_margin(lat):
+    # the furthest any point of a cell in this row can be from the cell's centre (cells
+    # are wider on the side closer to the equator)
+    return max(
+        get_distance(lat, 0, lat + grid_step / 2, grid_step / 2),
+        get_distance(lat, 0, lat - grid_step / 2, grid_step / 2),
+    )
+
+
+def resolve_cell(index, lat, lon, types, distance, margin):
+    # returns the id of the city that CityIndex.closest returns for every point within
+    # margin km of (lat, lon), or None if that can't be guaranteed. Moving by margin
+    # changes every distance by at most margin, so the centre's answer holds if the
+    # closest city is at least 2 * margin closer than the runner-up, and no city is within
+    # margin of the distance cutoff (where the ctype priority would kick in)
+    trees = sorted(
+        [(t, index.trees[t]) for t in types if t in index.trees],
+        key=lambda t: ctype_rank(ctypes.get(t[0])),
+    )
+    reach = distance_to_chord(distance + margin)
+    for _, tree in trees:
+        found = tree.nearest(lat, lon, max_chord=reach)
+        if found is None:
+            continue
+        closest = chord_to_distance(math.sqrt(found[0]))
+        if closest > distance - margin:
+            return None
+        runner_up = tree.nearest(
+            lat,
+            lon,
+            max_chord=distance_to_chord(closest + 2 * margin),
+            skip={found[1][0]},
+        )
+        return found[1][0] if runner_up is None else None
+
+    # nothing within the cutoff anywhere in the cell - closest city regardless of type
+    found = [f for f in [tree.nearest(lat, lon) for _, tree in trees] if f is not None]
+    if len(found) == 0:
+        return None
+    found = min(found, key=lambda f: f[0])
+    max_chord = distance_to_chord(chord_to_distance(math.sqrt(found[0])) + 2 * margin)
+    for _, tree in trees:
+        if tree.nearest(lat, lon, max_chord=max_chord, skip={found[1][0]}) is not None:
+            return None
+    return found[1][0]
+
+
+def build_city_grid(index, types, distance=grid_distance):
+    # yields (lat_idx, lon_start, city_id) runs - neighbouring cells mostly resolve to the
+    # same city, so only storing the cell where a new run starts keeps the table small.
+    # Cells that lie on a border between two cities (or on the distance cutoff) get a
+    # NULL city_id, and the server looks those up in the index instead
+    for lat_idx in range(grid_lat_cells):
+        lat = min_lat + (lat_idx + 0.5) * grid_step
+        margin = get_cell_margin(lat)
+        prev_id = None
+        for lon_idx in range(grid_lon_cells):
+            lon = min_lon + (lon_idx + 0.5) * grid_step
+            city_id = resolve_cell(index, lat, lon, types, distance, margin)
+            if lon_idx == 0 or city_id != prev_id:
+                yield lat_idx, lon_idx, city_id
+            prev_id = city_id
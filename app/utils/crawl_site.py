@@ -15,6 +15,7 @@ import datetime
 import requests
 
 from settings import db_file, data_folder, run_emergency, run_emergency_failed
+from generation import publish_generation
 
 
 logging.basicConfig(
@@ -95,3 +96,8 @@ try:
 except:
     open(run_emergency_failed, "w").write("")
     logging.info("Failed to perform emergency download with an Exception")
+
+# the server holds on to the emergency flags until it sees a new generation
+publish_generation(
+    datetime.datetime.now(pytz.timezone("Europe/Riga")).strftime("%Y%m%d%H%M")
+)
@@ -18,6 +18,7 @@ def do_aurora_download():
     update_time = datetime.datetime.now(pytz.timezone("Europe/Riga")).strftime(
         "%Y%m%d%H%M"
     )
+    # the server picks up the new grid file by itself, no need to publish a generation
     update_aurora_forecast(update_time)
 
 
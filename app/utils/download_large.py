@@ -1,14 +1,22 @@
 import json
 import pytz
-import sqlite3
 import logging
 import datetime
-import requests
 
 from time import sleep
 from utils import simlpify_string
-from settings import db_file
-from download_utils import lt_hourly_params, lt_daily_params, lt_day_icons, target_ds
+from download_utils import (
+    create_session,
+    lt_hourly_params,
+    lt_daily_params,
+    lt_day_icons,
+    target_ds,
+    update_city_grid_table,
+    update_city_warnings_table,
+    update_forecast_pivot_tables,
+)
+from bulk_writer import BulkWriter, connect
+from generation import next_generation
 from download_small import do_20_m_download
 from download_aurora import do_aurora_download
 
@@ -20,19 +28,73 @@ logging.basicConfig(
     format="%(asctime)s [%(levelname)s] %(message)s",
 )
 
+lt_timeout = 30  # seconds, per request
+
+
+def get_place_forecasts(place_data, code):
+    h_dates = []
+    for i in range(len(place_data["forecastTimestamps"]) - 1):
+        if int(place_data["forecastTimestamps"][i]["forecastTimeUtc"][11:13]) - int(
+            place_data["forecastTimestamps"][i + 1]["forecastTimeUtc"][11:13]
+        ) in {-1, 23}:
+            h_dates.append(place_data["forecastTimestamps"][i]["forecastTimeUtc"])
+        else:
+            break
+    h_dates = set(h_dates)
+    d_dates = {e["forecastTimeUtc"][:10] for e in place_data["forecastTimestamps"]}
+
+    params = [
+        (
+            code,
+            lt_hourly_params[k],
+            f["forecastTimeUtc"]
+            .replace(" ", "")
+            .replace("-", "")
+            .replace(":", "")[:12],
+            lt_day_icons[v] if k == "conditionCode" else v,
+        )
+        for f in place_data["forecastTimestamps"]
+        for k, v in f.items()
+        if f["forecastTimeUtc"] in h_dates and k in lt_hourly_params
+    ]
+
+    sorted_d_dates = sorted(d_dates)
+    for i in range(1, len(sorted_d_dates)):
+        tmp_day = [
+            e
+            for e in place_data["forecastTimestamps"]
+            if e["forecastTimeUtc"] >= f"{sorted_d_dates[i - 1][:10]} 09:00:00"
+            and e["forecastTimeUtc"] < f"{sorted_d_dates[i - 1][:10]} 21:00:00"
+        ]
+        tmp_night = [
+            e
+            for e in place_data["forecastTimestamps"]
+            if e["forecastTimeUtc"] >= f"{sorted_d_dates[i - 1][:10]} 21:00:00"
+            and e["forecastTimeUtc"] < f"{sorted_d_dates[i][:10]} 09:00:00"
+        ]
+        for k in tmp_day[0]:
+            if k in lt_daily_params:
+                for f in lt_daily_params[k]:
+                    params.append(
+                        (
+                            code,
+                            f[1],
+                            f"{tmp_day[0]['forecastTimeUtc'].replace(' ', '').replace('-', '').replace(':', '')[:8]}0000",
+                            f[0]([e[k] for e in tmp_day], [e[k] for e in tmp_night]),
+                        )
+                    )
+    return params
 
-def pull_lt_data(update_time):
-    upd_con = sqlite3.connect(db_file)
-    upd_cur = upd_con.cursor()
 
+def get_lt_data():
+    # everything gets downloaded before the next generation is started - the API gets
+    # paced, so this takes a good while, and other jobs would be waiting on the lock
+    session = create_session(1)
     place_data = None
-
     try:
-        places = [
-            e
-            for e in json.loads(requests.get("https://api.meteo.lt/v1/places").content)
-            if e["countryCode"] != "LV"
-        ]
+        r = session.get("https://api.meteo.lt/v1/places", timeout=lt_timeout)
+        r.raise_for_status()
+        places = [e for e in json.loads(r.content) if e["countryCode"] != "LV"]
         f_places = [
             [
                 p["code"],  # id
@@ -48,134 +110,86 @@ def pull_lt_data(update_time):
             for p in places
         ]
 
-        upd_cur.executemany(
-            f"""
-            INSERT INTO cities (id, source, name, search_name, lat, lon, type, county, country, update_time)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, {update_time})
-            ON CONFLICT(id, source) DO UPDATE SET
-                name=excluded.name,
-                search_name=excluded.search_name,
-                lat=excluded.lat,
-                lon=excluded.lon,
-                type=excluded.type,
-                county=excluded.county,
-                country=excluded.country,
-                update_time={update_time}
-        """,
-            f_places,
-        )
-        logging.info(f"TABLE 'cities' - LT - {upd_cur.rowcount} rows upserted")
-        upd_con.commit()
-        # TODO - moving deletion to its own separate step in the download process may make sense
-        # initial city dl deletes this stuff before we get here
-        upd_cur.execute(f"DELETE FROM cities WHERE update_time < {update_time}")
-        logging.info(f"TABLE 'cities' - LT - {upd_cur.rowcount} old rows deleted")
-        upd_con.commit()
-        logging.info("DB update finished")
-
+        forecasts = []
         for p in places:
-            place_data = json.loads(
-                requests.get(
-                    f"https://api.meteo.lt/v1/places/{p['code']}/forecasts/long-term"
-                ).content
+            r = session.get(
+                f"https://api.meteo.lt/v1/places/{p['code']}/forecasts/long-term",
+                timeout=lt_timeout,
             )
-            h_dates = []
-            for i in range(len(place_data["forecastTimestamps"]) - 1):
-                if int(
-                    place_data["forecastTimestamps"][i]["forecastTimeUtc"][11:13]
-                ) - int(
-                    place_data["forecastTimestamps"][i + 1]["forecastTimeUtc"][11:13]
-                ) in {-1, 23}:
-                    h_dates.append(
-                        place_data["forecastTimestamps"][i]["forecastTimeUtc"]
-                    )
-                else:
-                    break
-            h_dates = set(h_dates)
-            d_dates = {e["forecastTimeUtc"][:10] for e in place_data["forecastTimestamps"]}
-
-            params = [
-                [
-                    p["code"],
-                    lt_hourly_params[k],
-                    f["forecastTimeUtc"]
-                    .replace(" ", "")
-                    .replace("-", "")
-                    .replace(":", "")[:12],
-                    lt_day_icons[v] if k == "conditionCode" else v,
-                ]
-                for f in place_data["forecastTimestamps"]
-                for k, v in f.items()
-                if f["forecastTimeUtc"] in h_dates and k in lt_hourly_params
-            ]
-
-            sorted_d_dates = sorted(d_dates)
-            # print(sorted_d_dates)
-            for i in range(1, len(sorted_d_dates)):
-                tmp_day = [
-                    e
-                    for e in place_data["forecastTimestamps"]
-                    if e["forecastTimeUtc"] >= f"{sorted_d_dates[i - 1][:10]} 09:00:00"
-                    and e["forecastTimeUtc"] < f"{sorted_d_dates[i - 1][:10]} 21:00:00"
-                ]
-                tmp_night = [
-                    e
-                    for e in place_data["forecastTimestamps"]
-                    if e["forecastTimeUtc"] >= f"{sorted_d_dates[i - 1][:10]} 21:00:00"
-                    and e["forecastTimeUtc"] < f"{sorted_d_dates[i][:10]} 09:00:00"
-                ]
-                for k in tmp_day[0]:
-                    if k in lt_daily_params:
-                        for f in lt_daily_params[k]:
-                            params.append(
-                                [
-                                    p["code"],
-                                    f[1],
-                                    f"{tmp_day[0]['forecastTimeUtc'].replace(' ', '').replace('-', '').replace(':', '')[:8]}0000",
-                                    f[0](
-                                        [e[k] for e in tmp_day],
-                                        [e[k] for e in tmp_night],
-                                    ),
-                                ]
-                            )
-
+            r.raise_for_status()
+            place_data = json.loads(r.content)
+            forecasts.extend(get_place_forecasts(place_data, p["code"]))
             sleep(0.4)  # trying to stay below the advertised 180 rqs / minute
+    except Exception as e:
+        logging.error(f"LT download FAILED - {e}")
+        logging.error(place_data)
+        raise
+    finally:
+        session.close()
+    logging.info(
+        f"LT download finished - {len(f_places)} places, {len(forecasts)} forecasts"
+    )
+    return f_places, forecasts
 
-            batch_size = 10000
-            total = len(params)
-            batch_count = total // batch_size
-            for i in range(batch_count + 1):
-                upd_cur.executemany(
-                    f"""
-                    INSERT INTO forecast_cities (city_id, param_id, date, value, update_time)
-                    VALUES (?, ?, ?, ?, {update_time})
-                    ON CONFLICT(city_id, param_id, date) DO UPDATE SET
-                        value=excluded.value,
-                        update_time={update_time}
-                """,
-                    params[i * batch_size : (i + 1) * batch_size],
-                )
-                logging.info(
-                    f"TABLE 'forecast_cities' - LT - {upd_cur.rowcount} rows upserted (batch {i}/{batch_count}, total {total})"
-                )
-                upd_con.commit()
-
-        # upd_cur.execute(f"DELETE FROM forecast_cities WHERE update_time < {update_time}")
+
+def update_lt_tables(update_time, db_fpath, f_places, forecasts):
+    upd_con = connect(db_fpath)
+    try:
+        with BulkWriter(
+            upd_con,
+            "cities",
+            [
+                "id",
+                "source",
+                "name",
+                "search_name",
+                "lat",
+                "lon",
+                "type",
+                "county",
+                "country",
+            ],
+            ["id", "source"],
+            update_time,
+        ) as writer:
+            writer.add(f_places)
+            writer.merge()
+            # only LT cities - LV ones keep their update_time for as long as cities.csv
+            # doesn't change (the ingest skips unchanged files)
+            writer.cleanup(
+                "DELETE FROM cities WHERE update_time < ? AND source = 'LT'",
+                [update_time],
+            )
+        update_city_grid_table(update_time, upd_con)
+        update_city_warnings_table(update_time, upd_con)
+
+        # rows only get written if they're new or their values have changed
+        with BulkWriter(
+            upd_con,
+            "forecast_cities",
+            ["city_id", "param_id", "date", "value"],
+            ["city_id", "param_id", "date"],
+            update_time,
+            changed_only=True,
+        ) as writer:
+            writer.add(forecasts)
+            writer.merge()
+        # upd_cur.execute("DELETE FROM forecast_cities WHERE update_time < ?", [update_time])
         # logging.info(f"TABLE 'forecast_cities' - LT - {upd_cur.rowcount} old rows deleted")
         logging.info("TABLE 'forecast_cities' - LT - deletion currently disabled")
-        upd_con.commit()
+        update_forecast_pivot_tables(update_time, upd_con)
         logging.info("DB update finished")
-
-    except BaseException as e:
+    except Exception as e:
         logging.error(f"DB update FAILED - {e}")
-        logging.error(place_data)
-        raise e
+        raise
     finally:
         upd_con.close()
 
 
 def do_4_h_download(update_time):
-    pull_lt_data(update_time)
+    f_places, forecasts = get_lt_data()
+    with next_generation(update_time) as db_fpath:
+        update_lt_tables(update_time, db_fpath, f_places, forecasts)
 
 
 if __name__ == "__main__":
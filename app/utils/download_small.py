@@ -1,10 +1,13 @@
+import csv
 import datetime
+import hashlib
 import json
 import logging
 import os
 import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
 
-import pandas as pd
 import pytz
 import requests
 from download_aurora import do_aurora_download
@@ -13,11 +16,23 @@ from download_utils import (
     base_url,
     col_parsers,
     col_types,
+    create_session,
+    download_workers,
+    empty_values,
     forecast_s,
+    get_file_hash,
+    load_download_state,
+    save_download_state,
     table_conf,
     target_ds,
+    update_city_grid_table,
+    update_city_warnings_table,
+    update_forecast_pivot_tables,
     warning_s,
 )
+from bulk_writer import BulkWriter, connect
+from forecast_cleanup import cleanup_forecasts
+from generation import next_generation
 from settings import (
     data_folder,
     data_uptimerobot_folder,
@@ -25,6 +40,7 @@ from settings import (
     last_updated,
     run_emergency,
     run_emergency_failed,
+    update_failed,
 )
 
 from utils import daily_params, hourly_params
@@ -37,8 +53,23 @@ logging.basicConfig(
 )
 
 
-def refresh_file(url, fpath, verify_download):
-    r = requests.get(url, timeout=15)
+def refresh_file(url, fpath, verify_download, download_state, session):
+    # only asking for changes if the file is still the one that got downloaded - the
+    # emergency crawler overwrites the forecasts with its own data
+    file_hash = get_file_hash(fpath)
+    prev = download_state.get(fpath, {})
+    headers = {}
+    if file_hash is not None and prev.get("hash") == file_hash:
+        if prev.get("etag") is not None:
+            headers["If-None-Match"] = prev["etag"]
+        if prev.get("last_modified") is not None:
+            headers["If-Modified-Since"] = prev["last_modified"]
+
+    r = session.get(url, timeout=15, headers=headers)
+    if r.status_code == 304:
+        logging.info(f"{fpath} not modified")
+        os.utime(fpath)  # mtimes are used as the time of the last download
+        return False
     # TODO: there's a damaged .csv - may want to deal with this in a more generic fashion (?)
     r_text = (
         r.content.replace(b'""Lidosta', b'"Lidosta')
@@ -60,8 +91,18 @@ def refresh_file(url, fpath, verify_download):
         do_emergency_dl = curr_conf[0].get("do_emergency_dl", False)
 
     if r.status_code == 200 and verify_download(r_text, skip_if_empty):
-        with open(fpath, "wb") as f:  # this can be eiher a json or csv
-            f.write(r_text)
+        content_hash = hashlib.sha256(r_text).hexdigest()
+        if content_hash == file_hash:
+            logging.info(f"{fpath} unchanged")
+            os.utime(fpath)
+        else:
+            with open(fpath, "wb") as f:  # this can be eiher a json or csv
+                f.write(r_text)
+        download_state[fpath] = {
+            "etag": r.headers.get("ETag"),
+            "last_modified": r.headers.get("Last-Modified"),
+            "hash": content_hash,
+        }
         return False
     else:
         logging.error(f"{fpath} failed (status code {r.status_code})")
@@ -81,141 +122,159 @@ verif_funcs = {
 }
 
 
-def download_resources(ds_name):
+def refresh_dataset(ds_name, download_state, session):
+    # refreshes the dataset's metadata, returns (url, fpath) for each of its resources
     ds_path = f"{data_folder}{ds_name}.json"
     refresh_file(
-        f"{base_url}action/package_show?id={ds_name}", ds_path, verif_funcs["json"]
+        f"{base_url}action/package_show?id={ds_name}",
+        ds_path,
+        verif_funcs["json"],
+        download_state,
+        session,
     )
     ds_data = json.loads(open(ds_path, "r").read())
 
-    skipped_empty = False
+    resources = []
     for r in ds_data["result"]["resources"]:
+        fpath = f"{data_folder}{ds_name}/{r['url'].split('/')[-1]}"
         if False and ds_name == warning_s:  # looks like it may work - disabling for now
             # TODO: get rid of this when the source gets fixed
-            skipped_empty = (
-                refresh_file(
+            resources.append(
+                (
                     f"https://data.gov.lv/dati/lv/datastore/dump/{r['id']}?format=csv",
-                    f"{data_folder}{ds_name}/{r['url'].split('/')[-1]}",
-                    verif_funcs["csv"],
+                    fpath,
                 )
-                or skipped_empty
             )
         else:
-            skipped_empty = (
-                refresh_file(
-                    r["url"],
-                    f"{data_folder}{ds_name}/{r['url'].split('/')[-1]}",
-                    verif_funcs["csv"],
-                )
-                or skipped_empty
+            resources.append((r["url"], fpath))
+    return resources
+
+
+def download_resources(datasets, download_state):
+    # everything gets downloaded in parallel (metadata first, since it lists the
+    # resources), so the job takes as long as the slowest file rather than all of them
+    with (
+        create_session() as session,
+        ThreadPoolExecutor(max_workers=download_workers) as executor,
+    ):
+        resources = [
+            resource
+            for ds_resources in executor.map(
+                lambda ds: refresh_dataset(ds, download_state, session), datasets
             )
-
-    return skipped_empty
+            for resource in ds_resources
+        ]
+        skipped = list(
+            executor.map(
+                lambda r: refresh_file(
+                    r[0], r[1], verif_funcs["csv"], download_state, session
+                ),
+                resources,
+            )
+        )
+    return any(skipped)
 
 
 def clean_and_part_line(l):
     return [e[1:-1] if '"' == e[0] and '"' == e[-1] else e for e in l.split(",")]
 
 
-def update_table(t_conf, update_time, db_con):
-    logging.info(f"UPDATING '{t_conf['table_name']}'")
-    db_cur = db_con.cursor()
-    df = None
-
+def read_table_rows(t_conf):
+    # yields parsed rows from all of the table's files one at a time, so memory use doesn't
+    # depend on the size of the files
+    parsers = [
+        (i, col_parsers[c["type"]], empty_values.get(c["type"]))
+        for i, cols in enumerate(t_conf["cols"])
+        for c in cols
+    ]
+    width = len(t_conf["cols"])
     for data_file in t_conf["files"]:
-        tmp_df = pd.read_csv(data_file["name"]).dropna(how="all")
+        with open(data_file["name"], "r", newline="", encoding="utf-8-sig") as f:
+            reader = csv.reader(f)
+            next(reader, None)  # header
+            for row in reader:
+                if all(v == "" for v in row):
+                    continue  # blank lines and rows with nothing but separators
+                if len(row) < width:
+                    row += [""] * (width - len(row))
+                yield [
+                    empty if row[i] == "" else parse(row[i])
+                    for i, parse, empty in parsers
+                ]
 
-        for ct in range(len(t_conf["cols"])):
-            for col in t_conf["cols"][ct]:
-                tmp_df[f"_new_{col['name']}"] = tmp_df[tmp_df.columns[ct]].apply(
-                    col_parsers[col["type"]]
-                )
-        tmp_df = tmp_df[[f"_new_{c['name']}" for cols in t_conf["cols"] for c in cols]]
-        if df is None:
-            df = pd.DataFrame(tmp_df)
-        else:
-            df = pd.concat([df, tmp_df])
 
-    group_keys = [
-        f"_new_{c['name']}"
-        for cols in t_conf["cols"]
-        for c in cols
-        if c.get("pk", False)
-    ]
-    if len(group_keys) > 0:  # getting rid of duplicates
-        df = (
-            df.groupby(group_keys)
-            .max()
-            .reset_index()[
-                [f"_new_{c['name']}" for cols in t_conf["cols"] for c in cols]
-            ]
-        )
+def update_table(t_conf, update_time, db_con):
+    logging.info(f"UPDATING '{t_conf['table_name']}'")
+    db_cur = db_con.cursor()
 
-    pks = [c["name"] for cols in t_conf["cols"] for c in cols if c.get("pk", False)]
+    cols = [c for cols in t_conf["cols"] for c in cols]
+    pks = [c["name"] for c in cols if c.get("pk", False)]
     primary_key_q = "" if len(pks) < 1 else f", PRIMARY KEY ({', '.join(pks)})"
     db_cur.execute(f"""
         CREATE TABLE IF NOT EXISTS {t_conf["table_name"]} (
-            {", ".join([f"{c['name']} {col_types.get(c['type'], c['type'])}" for cols in t_conf["cols"] for c in cols])},
+            {", ".join([f"{c['name']} {col_types.get(c['type'], c['type'])}" for c in cols])},
             update_time INTEGER
             {primary_key_q}
         )
     """)
-    upsert_q = (
-        ""
-        if len(pks) == 0
-        else f"""
-        ON CONFLICT({", ".join(pks)}) DO UPDATE SET
-            {",".join([f"{c['name']}=excluded.{c['name']}" for cols in t_conf["cols"] for c in cols if not c.get("pk", False)])},
-            update_time={update_time}
-    """
-    )
-    full_q = f"""
-        INSERT INTO {t_conf["table_name"]} ({", ".join([c["name"] for cols in t_conf["cols"] for c in cols])}, update_time)
-        VALUES ({", ".join(["?"] * len([0 for cols in t_conf["cols"] for _ in cols]))}, {update_time})
-        {upsert_q}
-    """
-    total = len(df.index)
-    batch_size = 10000  # value selected arbitrarily - small enough to make batches fast, big enough to fit non-forecast data into a single batch
-    batch_count = total // batch_size
-    for i in range(batch_count + 1):
-        db_cur.executemany(
-            full_q, df.iloc[i * batch_size : (i + 1) * batch_size].values.tolist()
-        )
-        logging.info(
-            f"TABLE '{t_conf['table_name']}' - {db_cur.rowcount} rows upserted (batch {i}/{batch_count}, total {total})"
-        )
-        db_con.commit()
-    if t_conf["table_name"] == "forecast_cities":
-        if False:
-            # clocks getting turned can mess the data up - leaving this as a contingency in case I just need to clear out all of the old data
-            # TODO: it may be worth dealing with this in a more automated fashion
-            db_cur.execute(
-                f"DELETE FROM {t_conf['table_name']} WHERE update_time < {update_time}"
+    # secondary indexes, e.g. for cleaning out old rows without scanning the table
+    for index_cols in t_conf.get("indexes", []):
+        db_cur.execute(f"""
+            CREATE INDEX IF NOT EXISTS {t_conf["table_name"]}_{"_".join(index_cols)}_idx
+            ON {t_conf["table_name"]} ({", ".join(index_cols)})
+        """)
+    # duplicates in the files get merged by taking the max of every column (same as the
+    # old groupby().max()), and diff_upsert tables only get new or changed rows written
+    # (table_state has the time of the last download for those)
+    with BulkWriter(
+        db_con,
+        t_conf["table_name"],
+        [c["name"] for c in cols],
+        pks,
+        update_time,
+        dedupe=True,
+        changed_only=t_conf.get("diff_upsert", False),
+    ) as writer:
+        writer.add(read_table_rows(t_conf))
+        writer.merge()
+        if t_conf["table_name"] == "forecast_cities":
+            if False:
+                # clocks getting turned can mess the data up - leaving this as a contingency in case I just need to clear out all of the old data
+                # TODO: it may be worth dealing with this in a more automated fashion
+                writer.cleanup(f"""
+                    DELETE FROM {t_conf["table_name"]} AS t
+                    WHERE NOT EXISTS (
+                        SELECT 1 FROM {writer.staging_table} AS s
+                        WHERE s.city_id = t.city_id AND s.param_id = t.param_id AND s.date = t.date
+                    )
+                """)
+            else:
+                # dealing with cases when a single forecast param may have gone missing
+                cleanup_start = time.perf_counter()
+                writer.add_deleted(
+                    cleanup_forecasts(
+                        writer.cur,
+                        t_conf["table_name"],
+                        writer.staging_table,
+                        hourly_params,
+                        daily_params,
+                    ),
+                    time.perf_counter() - cleanup_start,
+                )
+        elif t_conf["table_name"] == "cities":
+            # making sure I don't delete LT cities
+            writer.cleanup(
+                f"DELETE FROM {t_conf['table_name']} WHERE update_time < ? AND source='LV'",
+                [update_time],
             )
         else:
-            # dealing with cases when a single forecast param may have gone missing
-            not_params = f"param_id NOT IN ({','.join([str(p) for p in hourly_params + daily_params])})"
-            h_where = f"param_id IN ({','.join([str(p) for p in hourly_params])})"
-            d_where = f"param_id IN ({','.join([str(p) for p in daily_params])})"
-            h_valid_dates = db_cur.execute(f"""
-                SELECT MIN(date), MAX(date) FROM {t_conf["table_name"]} WHERE update_time = {update_time} AND {h_where}
-            """).fetchall()  # better than getting all dates, but still slow
-            d_valid_dates = db_cur.execute(f"""
-                SELECT MIN(date), MAX(date) FROM {t_conf["table_name"]} WHERE update_time = {update_time} AND {d_where}
-            """).fetchall()  # better than getting all dates, but still slow
-            # TODO: I've made this very forecast_cities city specific now - need to do this so that deleting the lt sources will not mangle performance
-            # TODO: and the q is bad, but should work
-            db_cur.execute(f"""
-                DELETE FROM {t_conf["table_name"]}
-                WHERE
-                    ((date < {h_valid_dates[0][0]} OR date > {h_valid_dates[0][1]}) AND {h_where}) OR
-                    ((date < {d_valid_dates[0][0]} OR date > {d_valid_dates[0][1]}) AND {d_where}) OR
-                    {not_params} OR param_id IS NULL
-            """)
-        logging.info(
-            f"TABLE '{t_conf['table_name']}' - {db_cur.rowcount} old rows deleted"
-        )
-        db_con.commit()
+            writer.cleanup(
+                f"DELETE FROM {t_conf['table_name']} WHERE update_time < ?",
+                [update_time],
+            )
+
+    if t_conf["table_name"] == "forecast_cities":
+        update_forecast_pivot_tables(update_time, db_con)
 
         logging.info("UPDATING 'missing_params'")
         db_cur.execute("""
@@ -226,7 +285,8 @@ def update_table(t_conf, update_time, db_con):
                 update_time INTEGER
             )
         """)
-        missing_params = db_cur.execute(f"""
+        missing_params = db_cur.execute(
+            """
             WITH filtered_forecasts AS (
                	SELECT
               		COUNT(param_id) AS param_id, date, city_id , MAX(update_time) AS update_time
@@ -240,39 +300,26 @@ def update_table(t_conf, update_time, db_con):
             FROM
                 filtered_forecasts f JOIN cities c on f.city_id = c.id
             WHERE
-               	param_id < {MIN_PARAM_COUNT}
+               	param_id < ?
             GROUP BY
                	city_id
-        """).fetchall()
-        # db_cur.executemany(f"""
+        """,
+            [MIN_PARAM_COUNT],
+        ).fetchall()
+        # db_cur.executemany("""
         #     INSERT INTO missing_params (city_id, name, type, update_time)
-        #     VALUES (?, ?, ?, {update_time})
-        # """, missing_params)
+        #     VALUES (?, ?, ?, ?)
+        # """, [[*m, update_time] for m in missing_params])
         # logging.info(f"TABLE 'missing_params' - {db_cur.rowcount} rows upserted")
         # db_con.commit()
         # TODO: this interacts with the LT forecasts in a weird fashion atm, fix and reenable
         logging.info(f"TABLE 'missing_params' - skipping upsert for now")
-        db_cur.execute(f"DELETE FROM missing_params WHERE update_time < {update_time}")
-        logging.info(f"TABLE 'missing_params' - {db_cur.rowcount} old rows deleted")
-        db_con.commit()
-        logging.info("TABLE 'missing_params' updated")
-    elif t_conf["table_name"] == "cities":
-        # making sure I don't delete LT cities
-        db_cur.execute(
-            f"DELETE FROM {t_conf['table_name']} WHERE update_time < {update_time} AND source='LV'"
-        )
-        logging.info(
-            f"TABLE '{t_conf['table_name']}' - {db_cur.rowcount} old rows deleted"
-        )
-        db_con.commit()
-    else:
         db_cur.execute(
-            f"DELETE FROM {t_conf['table_name']} WHERE update_time < {update_time}"
-        )
-        logging.info(
-            f"TABLE '{t_conf['table_name']}' - {db_cur.rowcount} old rows deleted"
+            "DELETE FROM missing_params WHERE update_time < ?", [update_time]
         )
+        logging.info(f"TABLE 'missing_params' - {db_cur.rowcount} old rows deleted")
         db_con.commit()
+        logging.info("TABLE 'missing_params' updated")
     logging.info(f"TABLE '{t_conf['table_name']}' updated")
 
 
@@ -291,7 +338,8 @@ def update_warning_bounds_table(update_time, db_con):
             PRIMARY KEY (warning_id, polygon_id)
         )
     """)
-    db_cur.execute(f"""
+    db_cur.execute(
+        """
         INSERT INTO warning_bounds (warning_id, polygon_id, min_lat, max_lat, min_lon, max_lon, update_time)
         SELECT
             warning_id,
@@ -300,7 +348,7 @@ def update_warning_bounds_table(update_time, db_con):
             MAX(lat) as max_lat,
             MIN(lon) as min_lon,
             MAX(lon) as max_lon,
-            {update_time} as update_time
+            ? as update_time
         FROM
             warnings_polygons
         GROUP BY
@@ -311,29 +359,201 @@ def update_warning_bounds_table(update_time, db_con):
             min_lon=excluded.min_lon,
             max_lon=excluded.max_lon,
             update_time=excluded.update_time
-    """)
+    """,
+        [update_time],
+    )
     logging.info(f"TABLE 'warning_bounds' - {db_cur.rowcount} rows upserted")
     db_con.commit()
-    db_cur.execute(f"DELETE FROM warning_bounds WHERE update_time < {update_time}")
+    db_cur.execute("DELETE FROM warning_bounds WHERE update_time < ?", [update_time])
     logging.info(f"TABLE 'warning_bounds' - {db_cur.rowcount} old rows deleted")
     db_con.commit()
     logging.info("TABLE 'warning_bounds' updated")
 
+    logging.info("UPDATING 'warning_rtree'")
+    # the server looks up candidate polygons through this, and then checks the actual
+    # polygons - r-tree coordinates get rounded outwards, so the boxes never shrink
+    db_cur.execute("""
+        CREATE VIRTUAL TABLE IF NOT EXISTS warning_rtree USING rtree(
+            id,
+            min_lat, max_lat,
+            min_lon, max_lon,
+            +warning_id,
+            +polygon_id
+        )
+    """)
+    db_cur.execute("DELETE FROM warning_rtree")
+    db_cur.execute("""
+        INSERT INTO warning_rtree (min_lat, max_lat, min_lon, max_lon, warning_id, polygon_id)
+        SELECT
+            min_lat, max_lat, min_lon, max_lon, warning_id, polygon_id
+        FROM
+            warning_bounds
+    """)
+    logging.info(f"TABLE 'warning_rtree' - {db_cur.rowcount} rows inserted")
+    db_con.commit()
+    logging.info("TABLE 'warning_rtree' updated")
 
-def update_db(update_time):
-    upd_con = sqlite3.connect(db_file, timeout=5)
+
+def update_active_warnings_table(update_time, db_con):
+    logging.info("UPDATING 'active_warnings'")
+    db_cur = db_con.cursor()
+    db_cur.execute("""
+        CREATE TABLE IF NOT EXISTS active_warnings (
+            id INTEGER,
+            intensity_val INTEGER,
+            intensity_lv TEXT,
+            intensity_en TEXT,
+            regions_lv TEXT,
+            regions_en TEXT,
+            type_lv TEXT,
+            type_en TEXT,
+            time_from INTEGER,
+            time_to INTEGER,
+            description_lv TEXT,
+            description_en TEXT,
+            update_time INTEGER
+        )
+    """)
+    db_cur.execute(
+        "CREATE INDEX IF NOT EXISTS active_warnings_id_idx ON active_warnings (id)"
+    )
+    db_cur.execute(
+        "CREATE INDEX IF NOT EXISTS active_warnings_time_to_idx ON active_warnings (time_to)"
+    )
+    db_cur.execute("DELETE FROM active_warnings")
+    logging.info(f"TABLE 'active_warnings' - {db_cur.rowcount} old rows deleted")
+    # anything that has already expired can't show up in a response
+    db_cur.execute(
+        """
+        INSERT INTO active_warnings
+        SELECT DISTINCT
+            id,
+            CASE intensity_en
+                WHEN 'Red' THEN 3
+                WHEN 'Orange' THEN 2
+                WHEN 'Yellow' THEN 1
+            END as intensity_val,
+            intensity_lv,
+            intensity_en,
+            regions_lv,
+            regions_en,
+            type_lv,
+            type_en,
+            time_from,
+            time_to,
+            description_lv,
+            description_en,
+            ? AS update_time
+        FROM
+            warnings
+        WHERE
+            time_to > ?
+    """,
+        [update_time, update_time],
+    )
+    logging.info(f"TABLE 'active_warnings' - {db_cur.rowcount} rows inserted")
+    db_con.commit()
+    logging.info("TABLE 'active_warnings' updated")
+
+
+def get_inputs_hash(t_conf):
+    return hashlib.sha256(
+        json.dumps([get_file_hash(f["name"]) for f in t_conf["files"]]).encode()
+    ).hexdigest()
+
+
+def get_table_state(db_fpath):
+    # the inputs hash of every table in the db, empty if there's no db (or no table_state)
+    if not os.path.isfile(db_fpath):
+        return {}
+    db_con = sqlite3.connect(f"file:{db_fpath}?mode=ro", uri=True)
     try:
+        return dict(
+            db_con.execute("SELECT table_name, inputs_hash FROM table_state").fetchall()
+        )
+    except sqlite3.OperationalError:
+        return {}
+    finally:
+        db_con.close()
+
+
+def set_table_state(db_cur, table_name, inputs_hash, update_time):
+    db_cur.execute("""
+        CREATE TABLE IF NOT EXISTS table_state (
+            table_name TEXT PRIMARY KEY,
+            inputs_hash TEXT,
+            update_time INTEGER
+        )
+    """)
+    db_cur.execute(
+        """
+        INSERT INTO table_state (table_name, inputs_hash, update_time)
+        VALUES (?, ?, ?)
+        ON CONFLICT(table_name) DO UPDATE SET
+            inputs_hash=excluded.inputs_hash,
+            update_time=excluded.update_time
+    """,
+        [table_name, inputs_hash, update_time],
+    )
+
+
+def update_table_if_changed(t_conf, update_time, db_con, table_state, inputs_hash):
+    # returns True if the table got updated - the hashes live in the db, so they always
+    # describe what's in this particular db file
+    if table_state.get(t_conf["table_name"]) == inputs_hash:
+        logging.info(f"TABLE '{t_conf['table_name']}' - files unchanged, skipping")
+        return False
+
+    update_table(t_conf, update_time, db_con)
+    set_table_state(db_con.cursor(), t_conf["table_name"], inputs_hash, update_time)
+    db_con.commit()
+    return True
+
+
+def update_db(update_time, db_fpath, inputs_hashes):
+    # returns the names of the tables that failed to update
+    table_state = get_table_state(db_fpath)
+    upd_con = connect(db_fpath)
+    try:
+        updated = set()
+        failed = []
         for t_conf in table_conf:
-            update_table(t_conf, update_time, upd_con)
-        update_warning_bounds_table(update_time, upd_con)
+            try:
+                if update_table_if_changed(
+                    t_conf,
+                    update_time,
+                    upd_con,
+                    table_state,
+                    inputs_hashes[t_conf["table_name"]],
+                ):
+                    updated.add(t_conf["table_name"])
+            except Exception as e:
+                # the source occasionally serves damaged files - the table's transaction
+                # has been rolled back, so it keeps the previous generation's rows, and its
+                # table_state hasn't moved, so it gets retried by the next download
+                upd_con.rollback()
+                logging.error(f"TABLE '{t_conf['table_name']}' update FAILED - {e}")
+                failed.append(t_conf["table_name"])
+        # tables derived from the downloaded ones only need rebuilding if their inputs did
+        if "warnings_polygons" in updated:
+            update_warning_bounds_table(update_time, upd_con)
+        if len(updated & {"cities", "warnings", "warnings_polygons"}) > 0:
+            update_city_warnings_table(update_time, upd_con)
+        if "warnings" in updated:
+            update_active_warnings_table(update_time, upd_con)
+        # skips itself if cities haven't moved
+        update_city_grid_table(update_time, upd_con)
         logging.info("DB update finished")
-    except BaseException as e:
+        return failed
+    except Exception as e:
+        # re-raising so that next_generation throws the half built copy away
         logging.error(f"DB update FAILED - {e}")
+        raise
     finally:
         upd_con.close()
 
 
-def pull_uptimerobot_data(update_time):
+def get_uptimerobot_downtimes():
     uptime = [
         "/api/v1/forecast/cities (DOWN if city name is missing)",
         "/api/v1/forecast/cities (DOWN if daily forecast is an empty list)",
@@ -358,121 +578,168 @@ def pull_uptimerobot_data(update_time):
         "/api/v1/forecast/cities (DOWN if any forecast fields have defaulted to -999)": "forecast",
     }
 
-    if os.environ["UPTIMEROBOT"]:
-        url = "https://api.uptimerobot.com/v2/getMonitors"
-        r = requests.post(
-            url, data={"api_key": os.environ["UPTIMEROBOT"], "logs": 1}, timeout=10
-        )
-        if r.status_code == 200:
-            monit_data = json.loads(r.content)
-            with open(
-                f"{data_uptimerobot_folder}uptimerobot_metrics_response.json", "wb"
-            ) as mef:
-                mef.write(r.content)
-            metrics = {k: {} for k in meta.values()}
-            oldest_monit = min([e["create_datetime"] for e in monit_data["monitors"]])
-            metrics["downtime"] = {oldest_monit: oldest_monit}
-
-            for e in monit_data["monitors"]:
-                is_meta = e["friendly_name"] in meta
-                if is_meta:
-                    # adds a bunch of duplicate stuff if multiple monits are looking at a specific meta val, shouldn't matter since they'll be 0 len though
-                    metrics[meta[e["friendly_name"]]][e["create_datetime"]] = e[
-                        "create_datetime"
-                    ]
-                if is_meta or e["friendly_name"] in uptime:
-                    for ent in e["logs"]:
-                        if ent["type"] == 1:
-                            ek = (
-                                meta[e["friendly_name"]]
-                                if is_meta
-                                and ent["duration"] > 300
-                                and ent["reason"]["code"] != "333333"
-                                else "downtime"
-                            )
-                            end_dt = ent["datetime"] + ent["duration"]
-                            # work out if the current incidents start time falls within a different incident, and merge them if that's the case
-                            matches = {
-                                k: v
-                                for k, v in metrics[ek].items()
-                                if (
-                                    (
-                                        ent["datetime"] >= k and ent["datetime"] <= v
-                                    )  # new entries start falls within existing entry
-                                    or (
-                                        end_dt >= k and end_dt <= v
-                                    )  # new entries end falls within existing entry
-                                    or (
-                                        ent["datetime"] <= k and end_dt >= v
-                                    )  # old entry fully falls within the new one
-                                )
-                            }
-                            if len(matches) > 0:
-                                for k in matches:
-                                    del metrics[ek][k]
-                                metrics[ek][
-                                    min(min(matches.keys()), ent["datetime"])
-                                ] = max(max(matches.values()), end_dt)
-                            else:
-                                metrics[ek][ent["datetime"]] = end_dt
-
-            upd_con = sqlite3.connect(db_file)
-            upd_cur = upd_con.cursor()
-            try:
-                upd_cur.execute("""
-                    CREATE TABLE IF NOT EXISTS downtimes (
-                        type TEXT,
-                        start_time INTEGER,
-                        duration INTEGER,
-                        update_time INTEGER,
-                        PRIMARY KEY (type, start_time)
+    # returns [type, start_time, duration] rows, or None if there's no API key
+    api_key = os.environ.get("UPTIMEROBOT")
+    if not api_key:
+        return None
+    r = requests.post(
+        "https://api.uptimerobot.com/v2/getMonitors",
+        data={"api_key": api_key, "logs": 1},
+        timeout=10,
+    )
+    r.raise_for_status()
+    monit_data = json.loads(r.content)
+    with open(
+        f"{data_uptimerobot_folder}uptimerobot_metrics_response.json", "wb"
+    ) as mef:
+        mef.write(r.content)
+    metrics = {k: {} for k in meta.values()}
+    oldest_monit = min([e["create_datetime"] for e in monit_data["monitors"]])
+    metrics["downtime"] = {oldest_monit: oldest_monit}
+
+    for e in monit_data["monitors"]:
+        is_meta = e["friendly_name"] in meta
+        if is_meta:
+            # adds a bunch of duplicate stuff if multiple monits are looking at a specific meta val, shouldn't matter since they'll be 0 len though
+            metrics[meta[e["friendly_name"]]][e["create_datetime"]] = e[
+                "create_datetime"
+            ]
+        if is_meta or e["friendly_name"] in uptime:
+            for ent in e["logs"]:
+                if ent["type"] == 1:
+                    ek = (
+                        meta[e["friendly_name"]]
+                        if is_meta
+                        and ent["duration"] > 300
+                        and ent["reason"]["code"] != "333333"
+                        else "downtime"
                     )
-                """)
-                upd_cur.executemany(
-                    f"""
-                    INSERT INTO downtimes (type, start_time, duration, update_time)
-                    VALUES (?, ?, ?, {update_time})
-                    ON CONFLICT(type, start_time) DO UPDATE SET
-                        duration=excluded.duration,
-                        update_time={update_time}
-                """,
-                    [
-                        [ki, kj, vj - kj]
-                        for ki, vi in metrics.items()
-                        for kj, vj in vi.items()
-                    ],
-                )
-                logging.info(f"TABLE 'downtimes' - {upd_cur.rowcount} rows upserted")
-                upd_con.commit()
-                upd_cur.execute(
-                    f"DELETE FROM downtimes WHERE update_time < {update_time}"
-                )
-                logging.info(f"TABLE 'downtimes' - {upd_cur.rowcount} old rows deleted")
-                upd_con.commit()
-                logging.info("DB update finished")
-            except BaseException as e:
-                logging.error(f"DB update FAILED - {e}")
-            finally:
-                upd_con.close()
+                    end_dt = ent["datetime"] + ent["duration"]
+                    # work out if the current incidents start time falls within a different incident, and merge them if that's the case
+                    matches = {
+                        k: v
+                        for k, v in metrics[ek].items()
+                        if (
+                            (
+                                ent["datetime"] >= k and ent["datetime"] <= v
+                            )  # new entries start falls within existing entry
+                            or (
+                                end_dt >= k and end_dt <= v
+                            )  # new entries end falls within existing entry
+                            or (
+                                ent["datetime"] <= k and end_dt >= v
+                            )  # old entry fully falls within the new one
+                        )
+                    }
+                    if len(matches) > 0:
+                        for k in matches:
+                            del metrics[ek][k]
+                        metrics[ek][min(min(matches.keys()), ent["datetime"])] = max(
+                            max(matches.values()), end_dt
+                        )
+                    else:
+                        metrics[ek][ent["datetime"]] = end_dt
+
+    return [[ki, kj, vj - kj] for ki, vi in metrics.items() for kj, vj in vi.items()]
+
+
+def get_downtimes_hash(downtimes):
+    return hashlib.sha256(json.dumps(downtimes).encode()).hexdigest()
+
+
+def update_downtimes_table(update_time, db_con, downtimes):
+    logging.info("UPDATING 'downtimes'")
+    db_cur = db_con.cursor()
+    db_cur.execute("""
+        CREATE TABLE IF NOT EXISTS downtimes (
+            type TEXT,
+            start_time INTEGER,
+            duration INTEGER,
+            update_time INTEGER,
+            PRIMARY KEY (type, start_time)
+        )
+    """)
+    with BulkWriter(
+        db_con,
+        "downtimes",
+        ["type", "start_time", "duration"],
+        ["type", "start_time"],
+        update_time,
+    ) as writer:
+        writer.add(downtimes)
+        writer.merge()
+        writer.cleanup("DELETE FROM downtimes WHERE update_time < ?", [update_time])
+        set_table_state(
+            writer.cur, "downtimes", get_downtimes_hash(downtimes), update_time
+        )
+    logging.info("TABLE 'downtimes' updated")
+
+
+def update_downtimes(update_time, db_fpath, downtimes):
+    # the forecast update shouldn't fail over the metrics
+    upd_con = connect(db_fpath)
+    try:
+        update_downtimes_table(update_time, upd_con, downtimes)
+    except Exception as e:
+        logging.error(f"TABLE 'downtimes' update FAILED - {e}")
+    finally:
+        upd_con.close()
+
+
+def set_update_failed(update_time, failed):
+    # reported by /api/v1/meta, and stays there until a download updates everything
+    if len(failed) > 0:
+        with open(update_failed, "w") as f:
+            f.write(f"{update_time} {', '.join(failed)}")
+    elif os.path.isfile(update_failed):
+        os.remove(update_failed)
 
 
 def do_20_m_download(datasets, update_time):
     logging.info("Triggering refresh")
     skipped_empty = False
+    download_state = load_download_state()
     try:
-        for ds in datasets:
-            skipped_empty = download_resources(ds) or skipped_empty
+        skipped_empty = download_resources(datasets, download_state)
     except BaseException as e:
         logging.error(f"Download failed - {e}")
         skipped_empty = True
+    save_download_state(download_state)
 
     if skipped_empty and not os.path.isfile(run_emergency):
         logging.error("Failure encountered - setting emergency flag")
         with open(run_emergency, "w") as ref:
             ref.write("")
 
-    update_db(update_time)
-    pull_uptimerobot_data(update_time)
+    # fetched before the generation gets built, and the forecast update shouldn't fail
+    # (or wait on the network) over the metrics
+    try:
+        downtimes = get_uptimerobot_downtimes()
+    except Exception as e:
+        logging.error(f"UptimeRobot download FAILED - {e}")
+        downtimes = None
+
+    # nothing gets copied or published if none of the inputs have changed - every
+    # published generation has the server reopen its connections and rebuild its caches
+    inputs_hashes = {t["table_name"]: get_inputs_hash(t) for t in table_conf}
+    if downtimes is not None:
+        inputs_hashes["downtimes"] = get_downtimes_hash(downtimes)
+    if all(get_table_state(db_file).get(k) == v for k, v in inputs_hashes.items()):
+        logging.info("Inputs unchanged, skipping the DB update")
+        # every table is up to date with its files, including any that failed before
+        set_update_failed(update_time, [])
+    else:
+        try:
+            with next_generation(update_time) as db_fpath:
+                failed = update_db(update_time, db_fpath, inputs_hashes)
+                if downtimes is not None:
+                    update_downtimes(update_time, db_fpath, downtimes)
+        except Exception as e:
+            # the live db stays as it was, and last_updated doesn't move
+            logging.error(f"Generation {update_time} discarded - {e}")
+            set_update_failed(update_time, ["generation"])
+            return
+        set_update_failed(update_time, failed)
 
     if not skipped_empty:
         with open(last_updated, "w") as luf:
@@ -1,11 +1,18 @@
 import os
 import json
-import sqlite3
+import time
+import hashlib
+import calendar
 import logging
 import requests
 
+from requests.adapters import HTTPAdapter
+from urllib3.util import Retry
 from utils import hourly_params, daily_params, simlpify_string
-from settings import db_file, data_folder
+from aurora_grid import read_forecast_time, write_grid
+from city_index import CityIndex, build_city_grid, grid_version, location_ranges
+from geometry import Polygon
+from settings import aurora_grid_file, data_folder
 
 
 logging.basicConfig(
@@ -18,6 +25,28 @@ logging.basicConfig(
 
 base_url = "https://data.gov.lv/dati/api/3/"
 
+download_workers = 8
+
+
+def create_session(pool_size=download_workers):
+    # keep-alive connections shared between the download threads, with retries (and
+    # backoff) for connection errors and the statuses that are worth trying again
+    retry = Retry(
+        total=3,
+        backoff_factor=0.5,
+        status_forcelist=(429, 500, 502, 503, 504),
+        allowed_methods=("GET",),
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(
+        pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry
+    )
+    session = requests.Session()
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
 warning_s = "hidrometeorologiskie-bridinajumi"
 forecast_s = "meteorologiskas-prognozes-apdzivotam-vietam-jaunaka-datu-kopa"
 
@@ -27,26 +56,58 @@ target_ds = [warning_s, forecast_s]
 for ds in target_ds:
     os.makedirs(f"{data_folder}{ds}/", exist_ok=True)
 
+# parsers get the raw csv cells (strings) - empty cells never reach them, they become
+# empty_values[type] (None, i.e. NULL, unless listed) instead
+datetime_chars = str.maketrans("", "", ".- :T")
 col_parsers = {
-    "TEXT": lambda r: str(r).strip(),
-    "TITLE_TEXT": lambda r: str(r).strip().title(),
-    "CLEANED_TEXT": lambda r: simlpify_string(str(r).strip().lower()),
-    "INTEGER": lambda r: int(str(r).strip()),
-    "REAL": lambda r: float(str(r).strip()),
+    "TEXT": str.strip,
+    "TITLE_TEXT": lambda r: r.strip().title(),
+    "CLEANED_TEXT": lambda r: simlpify_string(r.strip().lower()),
+    "INTEGER": int,  # int and float ignore surrounding whitespace by themselves
+    "REAL": float,
     # TODO: do I really need minutes? - would mean that I consistently work with datetime strings that are YYYYMMDDHHMM
     # TODO: revert when the source gets fixed
-    # "DATEH": lambda r: str(r).strip().replace(".", "").replace("-", "").replace(" ", "").replace(":", "").ljust(12, "0")[:12] # YYYYMMDDHHMM
-    "DATEH": lambda r: str(r)
-    .strip()
-    .replace(".", "")
-    .replace("-", "")
-    .replace(" ", "")
-    .replace(":", "")
-    .replace("T", "")
-    .ljust(12, "0")[:12],  # YYYYMMDDHHMM
+    # "DATEH": lambda r: r.strip().replace(".", "").replace("-", "").replace(" ", "").replace(":", "").ljust(12, "0")[:12] # YYYYMMDDHHMM
+    # YYYYMMDDHHMM
+    "DATEH": lambda r: r.strip().translate(datetime_chars).ljust(12, "0")[:12],
     "CONST_LV": lambda _: "LV",
 }
 
+empty_values = {
+    "TEXT": "",
+    "TITLE_TEXT": "",
+    "CLEANED_TEXT": "",
+    "CONST_LV": "LV",
+}
+
+# ETags, Last-Modified dates and content hashes of the downloaded files, so that
+# unchanged files don't have to be downloaded (or ingested) again
+download_state_file = f"{data_folder}download_state.json"
+
+
+def load_download_state():
+    try:
+        with open(download_state_file, "r") as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return {}
+
+
+def save_download_state(download_state):
+    tmp_fpath = f"{download_state_file}.tmp"
+    with open(tmp_fpath, "w") as f:
+        json.dump(download_state, f)
+    os.replace(tmp_fpath, download_state_file)
+
+
+def get_file_hash(fpath):
+    try:
+        with open(fpath, "rb") as f:
+            return hashlib.file_digest(f, "sha256").hexdigest()
+    except FileNotFoundError:
+        return None
+
+
 col_types = {
     "DATEH": "INTEGER",
     "CONST_LV": "TEXT",
@@ -60,6 +121,7 @@ table_conf = [
             {"name": f"{data_folder}{forecast_s}/cities.csv", "skip_if_empty": True}
         ],
         "table_name": "cities",
+        "indexes": [["update_time"]],
         "cols": [
             [
                 {"name": "id", "type": "TEXT", "pk": True},
@@ -86,6 +148,7 @@ table_conf = [
             }
         ],
         "table_name": "forecast_cities_params",
+        "indexes": [["update_time"]],
         "cols": [
             [{"name": "id", "type": "INTEGER", "pk": True}],
             [{"name": "title_lv", "type": "TEXT"}],
@@ -105,6 +168,7 @@ table_conf = [
             },
         ],
         "table_name": "forecast_cities",
+        "diff_upsert": True,  # most values stay the same between downloads
         "cols": [
             [{"name": "city_id", "type": "TEXT", "pk": True}],
             [{"name": "param_id", "type": "INTEGER", "pk": True}],
@@ -115,6 +179,7 @@ table_conf = [
     {
         "files": [{"name": f"{data_folder}{warning_s}/novadi.csv"}],
         "table_name": "municipalities",
+        "indexes": [["update_time"]],
         "cols": [
             [{"name": "id", "type": "INTEGER", "pk": True}],
             [{"name": "name_lv", "type": "TEXT"}],
@@ -124,6 +189,7 @@ table_conf = [
     {
         "files": [{"name": f"{data_folder}{warning_s}/bridinajumu_novadi.csv"}],
         "table_name": "warnings_municipalities",
+        "indexes": [["update_time"]],
         "cols": [
             [{"name": "warning_id", "type": "INTEGER"}],
             [{"name": "municipality_id", "type": "INTEGER"}],
@@ -132,6 +198,7 @@ table_conf = [
     {
         "files": [{"name": f"{data_folder}{warning_s}/bridinajumu_poligoni.csv"}],
         "table_name": "warnings_polygons",
+        "indexes": [["update_time"]],
         "cols": [
             [{"name": "warning_id", "type": "INTEGER", "pk": True}],
             [{"name": "polygon_id", "type": "INTEGER", "pk": True}],
@@ -143,6 +210,7 @@ table_conf = [
     {  # TODO: partial at the moment - finish this
         "files": [{"name": f"{data_folder}{warning_s}/bridinajumu_metadata.csv"}],
         "table_name": "warnings",
+        "indexes": [["update_time"]],
         "cols": [
             [{"name": "number", "type": "TEXT", "pk": True}],
             [{"name": "id", "type": "INTEGER", "pk": True}],
@@ -270,57 +338,263 @@ lt_daily_params = {
 }
 
 
-def update_aurora_forecast(update_time):  # TODO: cleanup
+def update_forecast_pivot_tables(update_time, db_con):
+    # forecasts get served one row per date with a column per param, pivoting them here
+    # so that requests don't have to
+    db_cur = db_con.cursor()
+    for table_name, params in [
+        ("forecast_cities_hourly", hourly_params),
+        ("forecast_cities_daily", daily_params),
+    ]:
+        logging.info(f"UPDATING '{table_name}'")
+        time_q = "date"
+        if table_name == "forecast_cities_daily":
+            # dealing with the clock getting turned forward
+            time_q = """
+                CASE WHEN date % 10000 = 2300 THEN
+                    CAST(strftime('%Y%m%d%H%M', printf('%s-%s-%s %s:%s', substr(date, 1, 4), substr(date, 5, 2), substr(date, 7, 2), substr(date, 9, 2), substr(date, 11, 2)), '+1 hour') AS INTEGER)
+                ELSE
+                    date
+                END
+            """
+        # rebuilding from scratch in a single transaction, readers get to see either the
+        # old or the new version of the table, and param lists are free to change
+        # (vals are left untyped so that the -999 defaults stay integers)
+        db_cur.execute("BEGIN")
+        db_cur.execute(f"DROP TABLE IF EXISTS {table_name}")
+        db_cur.execute(f"""
+            CREATE TABLE {table_name} (
+                city_id TEXT,
+                date INTEGER,
+                time INTEGER,
+                {", ".join([f"val_{p}" for p in params])},
+                update_time INTEGER,
+                PRIMARY KEY (city_id, date)
+            ) WITHOUT ROWID
+        """)
+        db_cur.execute(
+            f"""
+            INSERT INTO {table_name}
+            SELECT
+                city_id,
+                date,
+                {time_q} AS time,
+                {",".join([f"IFNULL(MAX(CASE WHEN param_id={p} THEN value END), -999) AS val_{p}" for p in params])},
+                ? AS update_time
+            FROM
+                forecast_cities
+            WHERE
+                param_id IN ({",".join([str(p) for p in params])})
+            GROUP BY
+                city_id, date
+        """,
+            [update_time],
+        )
+        logging.info(f"TABLE '{table_name}' - {db_cur.rowcount} rows inserted")
+        db_con.commit()
+        logging.info(f"TABLE '{table_name}' updated")
+
+
+def update_city_grid_table(update_time, db_con):
+    logging.info("UPDATING 'city_grid'")
+    db_cur = db_con.cursor()
+    db_cur.execute("""
+        CREATE TABLE IF NOT EXISTS city_grid (
+            location_range TEXT,
+            lat_idx INTEGER,
+            lon_start INTEGER,
+            city_id TEXT,
+            update_time INTEGER,
+            PRIMARY KEY (location_range, lat_idx, lon_start)
+        ) WITHOUT ROWID
+    """)
+    db_cur.execute("""
+        CREATE TABLE IF NOT EXISTS city_grid_state (
+            cities_hash TEXT,
+            update_time INTEGER
+        )
+    """)
+    cities = db_cur.execute(
+        "SELECT id, name, lat, lon, type FROM cities ORDER BY id, source"
+    ).fetchall()
+    # building the grid takes a while, and cities rarely change - skipping if nothing has moved
+    cities_hash = hashlib.sha256(
+        json.dumps([grid_version, [[c[0], c[2], c[3], c[4]] for c in cities]]).encode()
+    ).hexdigest()
+    prev_hash = db_cur.execute("SELECT cities_hash FROM city_grid_state").fetchall()
+    if len(prev_hash) > 0 and prev_hash[0][0] == cities_hash:
+        logging.info("TABLE 'city_grid' - cities unchanged, skipping")
+        return
+
+    index = CityIndex(cities)
+    for range_name, types in location_ranges.items():
+        db_cur.executemany(
+            """
+            INSERT INTO city_grid (location_range, lat_idx, lon_start, city_id, update_time)
+            VALUES (?, ?, ?, ?, ?)
+            ON CONFLICT(location_range, lat_idx, lon_start) DO UPDATE SET
+                city_id=excluded.city_id,
+                update_time=excluded.update_time
+        """,
+            (
+                (range_name, *cell, update_time)
+                for cell in build_city_grid(index, types)
+            ),
+        )
+        logging.info(
+            f"TABLE 'city_grid' - {range_name} - {db_cur.rowcount} rows upserted"
+        )
+    db_cur.execute("DELETE FROM city_grid WHERE update_time < ?", [update_time])
+    logging.info(f"TABLE 'city_grid' - {db_cur.rowcount} old rows deleted")
+    db_cur.execute("DELETE FROM city_grid_state")
+    db_cur.execute(
+        "INSERT INTO city_grid_state (cities_hash, update_time) VALUES (?, ?)",
+        [cities_hash, update_time],
+    )
+    db_con.commit()
+    logging.info("TABLE 'city_grid' updated")
+
+
+def update_city_warnings_table(update_time, db_con):
+    logging.info("UPDATING 'city_warnings'")
+    db_cur = db_con.cursor()
+    db_cur.execute("""
+        CREATE TABLE IF NOT EXISTS city_warnings (
+            city_id TEXT,
+            warning_id INTEGER,
+            update_time INTEGER,
+            PRIMARY KEY (city_id, warning_id)
+        ) WITHOUT ROWID
+    """)
+    polygon_points = {}
+    for e in db_cur.execute("""
+        SELECT
+            warning_id, polygon_id, lat, lon
+        FROM
+            warnings_polygons
+        ORDER BY
+            warning_id, polygon_id, order_id
+    """).fetchall():
+        polygon_points.setdefault((e[0], e[1]), []).append((e[2], e[3]))
+    polygons = {k: Polygon(v) for k, v in polygon_points.items()}
+    # the r-tree narrows things down to the polygons whose bounding boxes contain the
+    # city, and only those get checked against the actual polygon
+    candidates = db_cur.execute("""
+        SELECT
+            c.id, c.lat, c.lon, r.warning_id, r.polygon_id
+        FROM
+            cities AS c INNER JOIN warning_rtree AS r ON
+                r.min_lat <= c.lat AND r.max_lat >= c.lat
+                AND r.min_lon <= c.lon AND r.max_lon >= c.lon
+    """).fetchall()
+    city_warnings = sorted(
+        {
+            (c[0], c[3])
+            for c in candidates
+            if (c[3], c[4]) in polygons and polygons[(c[3], c[4])].contains(c[1], c[2])
+        }
+    )
+    db_cur.execute("DROP TABLE IF EXISTS temp.city_warning_candidates")
+    db_cur.execute("""
+        CREATE TEMP TABLE city_warning_candidates (
+            city_id TEXT,
+            warning_id INTEGER
+        )
+    """)
+    db_cur.executemany(
+        "INSERT INTO city_warning_candidates (city_id, warning_id) VALUES (?, ?)",
+        city_warnings,
+    )
+    # warnings come and go between downloads, rebuilding the whole mapping in a single
+    # transaction so that readers never see a half updated one
+    db_cur.execute("DELETE FROM city_warnings")
+    logging.info(f"TABLE 'city_warnings' - {db_cur.rowcount} old rows deleted")
+    # the weather service occasionally serves the same warnings
+    # for the same area, and with the same text, but with two
+    # different intensity levels - keeping only the highest intensity
+    # (per city, since that's the area that a response covers)
+    db_cur.execute(
+        """
+        INSERT INTO city_warnings (city_id, warning_id, update_time)
+        WITH warning_levels AS (
+            SELECT DISTINCT
+                cw.city_id,
+                w.id,
+                CASE w.intensity_en
+                    WHEN 'Red' THEN 3
+                    WHEN 'Orange' THEN 2
+                    WHEN 'Yellow' THEN 1
+                END as intensity_level,
+                w.type_lv,
+                w.description_lv
+            FROM
+                city_warning_candidates AS cw INNER JOIN warnings AS w ON
+                    w.id = cw.warning_id
+        ),
+        warnings_unique_texts AS (
+            SELECT
+                city_id,
+                max(intensity_level) AS max_intensity,
+                type_lv,
+                description_lv
+            FROM
+                warning_levels
+            GROUP BY
+                city_id,
+                type_lv,
+                description_lv
+        )
+        SELECT DISTINCT
+            wl.city_id,
+            wl.id,
+            ? AS update_time
+        FROM
+            warning_levels AS wl INNER JOIN warnings_unique_texts AS wt ON
+                wl.city_id = wt.city_id
+                AND wl.intensity_level = wt.max_intensity
+                AND wl.type_lv = wt.type_lv
+                AND wl.description_lv = wt.description_lv
+    """,
+        [update_time],
+    )
+    logging.info(f"TABLE 'city_warnings' - {db_cur.rowcount} rows inserted")
+    db_con.commit()
+    logging.info("TABLE 'city_warnings' updated")
+
+
+def update_aurora_forecast(update_time):
+    # returns True if a new forecast was written
     url = "https://services.swpc.noaa.gov/json/ovation_aurora_latest.json"
     fpath = f"{data_folder}ovation_aurora_latest.json"
     times_fpath = f"{data_folder}ovation_aurora_times.json"
 
     r = requests.get(url, timeout=10)
-    if r.status_code == 200:
-        with open(fpath, "wb") as f:
-            f.write(r.content)
-        aurora_data = json.loads(r.content)
-        with open(times_fpath, "w") as f:
-            f.write(
-                json.dumps(
-                    {
-                        "Observation Time": aurora_data["Observation Time"],
-                        "Forecast Time": aurora_data["Forecast Time"],
-                    }
-                )
-            )
+    if r.status_code != 200:
+        logging.error(f"{fpath} failed (status code {r.status_code})")
+        return False
+    aurora_data = json.loads(r.content)
+    forecast_time = calendar.timegm(
+        time.strptime(aurora_data["Forecast Time"], "%Y-%m-%dT%H:%M:%SZ")
+    )
+    if forecast_time == read_forecast_time(aurora_grid_file):
+        logging.info(
+            f"Aurora forecast for {aurora_data['Forecast Time']} already stored, skipping"
+        )
+        return False
 
-        upd_con = sqlite3.connect(db_file)
-        upd_cur = upd_con.cursor()
-        try:
-            upd_cur.execute("""
-                CREATE TABLE IF NOT EXISTS aurora_prob (
-                    lon INTEGER,
-                    lat INTEGER,
-                    aurora INTEGER,
-                    update_time DATEH,
-                    PRIMARY KEY (lon, lat)
-                )
-            """)
-            upd_cur.executemany(
-                f"""
-                INSERT INTO aurora_prob (lon, lat, aurora, update_time)
-                VALUES (?, ?, ?, {update_time})
-                ON CONFLICT(lon, lat) DO UPDATE SET
-                    aurora=excluded.aurora,
-                    update_time={update_time}
-            """,
-                aurora_data["coordinates"],
-            )
-            logging.info(f"TABLE 'aurora_prob' - {upd_cur.rowcount} rows upserted")
-            upd_con.commit()
-            upd_cur.execute(
-                f"DELETE FROM aurora_prob WHERE update_time < {update_time}"
+    with open(fpath, "wb") as f:
+        f.write(r.content)
+    with open(times_fpath, "w") as f:
+        f.write(
+            json.dumps(
+                {
+                    "Observation Time": aurora_data["Observation Time"],
+                    "Forecast Time": aurora_data["Forecast Time"],
+                }
             )
-            logging.info(f"TABLE 'aurora_prob' - {upd_cur.rowcount} old rows deleted")
-            upd_con.commit()
-            logging.info("DB update finished")
-        except BaseException as e:
-            logging.error(f"DB update FAILED - {e}")
-        finally:
-            upd_con.close()
+        )
+    write_grid(aurora_grid_file, forecast_time, aurora_data["coordinates"])
+    logging.info(
+        f"Aurora grid for {aurora_data['Forecast Time']} written ({len(aurora_data['coordinates'])} points, update {update_time})"
+    )
+    return True
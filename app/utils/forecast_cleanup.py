@@ -0,0 +1,42 @@
+# shared between the download job and utils/benchmark_cleanup.py, so no repo imports here
+def cleanup_forecasts(db_cur, table_name, staging_table, hourly_params, daily_params):
+    # deletes forecasts that fall outside of the dates that came with this download, and
+    # anything for params that aren't served. Returns the number of rows deleted
+    #
+    # this is still a full scan of the table - a (param_id, date) index didn't make it
+    # any faster (see utils/benchmark_cleanup.py), and slowed down every upsert
+    h_where = f"param_id IN ({','.join([str(p) for p in hourly_params])})"
+    d_where = f"param_id IN ({','.join([str(p) for p in daily_params])})"
+    not_params = (
+        f"param_id NOT IN ({','.join([str(p) for p in hourly_params + daily_params])})"
+    )
+    # the staged rows are exactly the ones that came with this download - unchanged rows
+    # keep their old update_time, so it can't be used to find them
+    valid_dates = db_cur.execute(f"""
+        SELECT
+            MIN(CASE WHEN {h_where} THEN date END),
+            MAX(CASE WHEN {h_where} THEN date END),
+            MIN(CASE WHEN {d_where} THEN date END),
+            MAX(CASE WHEN {d_where} THEN date END)
+        FROM
+            {staging_table}
+    """).fetchone()
+
+    # comparisons with NULL are never true, so nothing gets deleted for a group of
+    # params that didn't come with the download at all
+    db_cur.execute(
+        f"""
+        DELETE FROM {table_name}
+        WHERE
+            ((date < :h_min OR date > :h_max) AND {h_where}) OR
+            ((date < :d_min OR date > :d_max) AND {d_where}) OR
+            {not_params} OR param_id IS NULL
+    """,
+        {
+            "h_min": valid_dates[0],
+            "h_max": valid_dates[1],
+            "d_min": valid_dates[2],
+            "d_max": valid_dates[3],
+        },
+    )
+    return db_cur.rowcount
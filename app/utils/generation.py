@@ -0,0 +1,61 @@
+import os
+import fcntl
+import sqlite3
+import logging
+import contextlib
+
+from settings import db_file, generation_file
+
+next_db_file = f"{db_file}.next"
+lock_file = f"{db_file}.lock"
+
+
+def publish_generation(update_time):
+    # the server rebuilds its in-memory indexes and cached flags when this file changes
+    tmp_fpath = f"{generation_file}.tmp"
+    with open(tmp_fpath, "w") as f:
+        f.write(str(update_time))
+    os.replace(tmp_fpath, generation_file)
+    logging.info(f"Generation {update_time} published")
+
+
+def copy_db(src_fpath, dst_fpath):
+    if os.path.isfile(dst_fpath):
+        os.remove(dst_fpath)  # left behind by a job that didn't finish
+    src_con = sqlite3.connect(src_fpath)
+    dst_con = sqlite3.connect(dst_fpath)
+    try:
+        src_con.backup(dst_con)
+        # the server opens the published file as immutable, which only works for
+        # rollback journal dbs (the backup carries over the WAL flag if the source had it)
+        dst_con.execute("PRAGMA journal_mode=DELETE")
+    finally:
+        dst_con.close()
+        src_con.close()
+
+
+@contextlib.contextmanager
+def next_generation(update_time):
+    # the live db never gets written to - jobs build the next generation in a copy of it
+    # and swap it in once they're done, so the server never waits on (or sees half of) an
+    # update. Only one job builds at a time, otherwise they'd drop each other's changes
+    with open(lock_file, "w") as lf:
+        fcntl.flock(lf, fcntl.LOCK_EX)
+        try:
+            copy_db(db_file, next_db_file)
+            logging.info(f"Building generation {update_time} in '{next_db_file}'")
+            yield next_db_file
+            # the jobs write with synchronous=OFF (see bulk_writer.py), so nothing is
+            # guaranteed to be on disk until it's synced here
+            with open(next_db_file, "rb") as f:
+                os.fsync(f.fileno())
+            # the live db used to be in WAL mode - a leftover WAL file next to the new db
+            # would get applied to it by the next connection that isn't immutable
+            for suffix in ("-wal", "-shm"):
+                if os.path.isfile(f"{db_file}{suffix}"):
+                    os.remove(f"{db_file}{suffix}")
+            os.replace(next_db_file, db_file)
+            publish_generation(update_time)
+        finally:
+            if os.path.isfile(next_db_file):
+                os.remove(next_db_file)
@@ -0,0 +1,35 @@
+from array import array
+
+
+class Polygon:
+    # a single warning polygon ring, with its bounding box for a cheap first check
+    def __init__(self, points):
+        # points - (lat, lon) pairs in drawing order, the ring may or may not be closed
+        self.lats = array("d", [p[0] for p in points])
+        self.lons = array("d", [p[1] for p in points])
+        self.min_lat = min(self.lats, default=0.0)
+        self.max_lat = max(self.lats, default=0.0)
+        self.min_lon = min(self.lons, default=0.0)
+        self.max_lon = max(self.lons, default=0.0)
+
+    def __len__(self):
+        return len(self.lats)
+
+    def contains(self, lat, lon):
+        if len(self) < 3:
+            return False
+        if not (
+            self.min_lat <= lat <= self.max_lat and self.min_lon <= lon <= self.max_lon
+        ):
+            return False
+        # ray casting - counting how many edges a ray going east from the point crosses
+        lats, lons = self.lats, self.lons
+        inside = False
+        j = len(lats) - 1
+        for i in range(len(lats)):
+            if (lats[i] > lat) != (lats[j] > lat) and lon < (lons[j] - lons[i]) * (
+                lat - lats[i]
+            ) / (lats[j] - lats[i]) + lons[i]:
+                inside = not inside
+            j = i
+        return inside
@@ -0,0 +1,71 @@
+import gzip
+import time
+import hashlib
+
+import brotli
+
+# download jobs run at :00, :20 and :40 - anything served before then stays current
+download_interval = 20 * 60  # seconds
+
+
+class EncodedBody:
+    # a response body along with its compressed versions and its ETag
+    __slots__ = ("body", "gzip", "br", "body_hash")
+
+    def __init__(self, body):
+        self.body = body
+        self.gzip = gzip.compress(body, compresslevel=9)
+        self.br = brotli.compress(body, quality=9)
+        # the cache keys responses on the data generation and city, and the hash covers
+        # anything that changes within a generation (expired forecast rows etc.)
+        self.body_hash = hashlib.blake2b(body, digest_size=16).hexdigest()
+
+    def etag(self, encoding):
+        # strong ETags have to differ between encodings, since the bytes differ
+        if encoding == "identity":
+            return f'"{self.body_hash}"'
+        return f'"{self.body_hash}-{encoding}"'
+
+    def etag_matches(self, if_none_match):
+        # If-None-Match uses weak comparison, and any encoding of the same body will do
+        if if_none_match is None:
+            return False
+        tags = [t.strip() for t in if_none_match.split(",")]
+        if "*" in tags:
+            return True
+        etags = {self.etag(e) for e in ("identity", "gzip", "br")}
+        return any((t[2:] if t.startswith("W/") else t) in etags for t in tags)
+
+    def get(self, encoding):
+        match encoding:
+            case "br":
+                return self.br
+            case "gzip":
+                return self.gzip
+            case _:
+                return self.body
+
+
+def select_encoding(accept_encoding):
+    # picks the best encoding the client accepts - no need for full q-value ordering,
+    # brotli is always preferred if it's allowed at all
+    accepted = {}
+    for part in (accept_encoding or "").split(","):
+        name, _, params = part.strip().partition(";")
+        q = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                q = float(params[2:])
+            except ValueError:
+                q = 0.0
+        accepted[name.strip().lower()] = q
+    for encoding in ("br", "gzip"):
+        if accepted.get(encoding, accepted.get("*", 0.0)) > 0:
+            return encoding
+    return "identity"
+
+
+def get_max_age(now=None):
+    now = time.time() if now is None else now
+    return int(download_interval - now % download_interval)
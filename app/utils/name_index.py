@@ -0,0 +1,403 @@
+from functools import lru_cache
+
+from utils.city_index import ctype_rank, ctypes
+
+# a port of the spellfix1 editdist() cost model (what sqlean's fuzzy_editdist uses),
+# so that results match what the old SQL query returned
+#
+# character classes for ASCII characters
+CCLASS_SILENT = 0  # h
+CCLASS_VOWEL = 1  # a e i o u (y)
+CCLASS_B = 2  # b f p v w
+CCLASS_C = 3  # c g j k q s x z
+CCLASS_D = 4  # d t
+CCLASS_H = 5  # h at the beginning of a word
+CCLASS_L = 6  # l
+CCLASS_R = 7  # r
+CCLASS_M = 8  # m n
+CCLASS_Y = 9  # y at the beginning of a word
+CCLASS_DIGIT = 10
+CCLASS_SPACE = 11
+CCLASS_OTHER = 12
+
+_letter_classes = {
+    "a": CCLASS_VOWEL,
+    "b": CCLASS_B,
+    "c": CCLASS_C,
+    "d": CCLASS_D,
+    "e": CCLASS_VOWEL,
+    "f": CCLASS_B,
+    "g": CCLASS_C,
+    "h": CCLASS_SILENT,
+    "i": CCLASS_VOWEL,
+    "j": CCLASS_C,
+    "k": CCLASS_C,
+    "l": CCLASS_L,
+    "m": CCLASS_M,
+    "n": CCLASS_M,
+    "o": CCLASS_VOWEL,
+    "p": CCLASS_B,
+    "q": CCLASS_C,
+    "r": CCLASS_R,
+    "s": CCLASS_C,
+    "t": CCLASS_D,
+    "u": CCLASS_VOWEL,
+    "v": CCLASS_B,
+    "w": CCLASS_B,
+    "x": CCLASS_C,
+    "y": CCLASS_VOWEL,
+    "z": CCLASS_C,
+}
+
+
+def _build_class_table(overrides):
+    table = [CCLASS_OTHER] * 128
+    for c in "0123456789":
+        table[ord(c)] = CCLASS_DIGIT
+    for c in " \t\n\r":
+        table[ord(c)] = CCLASS_SPACE
+    for c, cclass in {**_letter_classes, **overrides}.items():
+        table[ord(c)] = cclass
+        table[ord(c.upper())] = cclass
+    return table
+
+
+_mid_class = _build_class_table({})
+_init_class = _build_class_table({"h": CCLASS_H, "y": CCLASS_Y})
+
+FINAL_INS_COST_DIV = 4
+
+
+def _char_class(c_prev, c):
+    return _init_class[c & 0x7F] if c_prev == 0 else _mid_class[c & 0x7F]
+
+
+def _ins_del_cost(c_prev, c, c_next):
+    c_class = _char_class(c_prev, c)
+    if c_class == CCLASS_SILENT:
+        return 1
+    if c_prev == c:
+        return 10
+    if c_class == CCLASS_VOWEL and (c_prev == 114 or c_next == 114):  # 'r'
+        return 20
+    if c_class == _char_class(c_prev, c_prev):
+        return 15 if c_class == CCLASS_VOWEL else 50
+    return 100
+
+
+def _sub_cost(c_prev, c_from, c_to):
+    if c_from == c_to:
+        return 0
+    if c_from == (c_to ^ 0x20) and (65 <= c_to <= 90 or 97 <= c_to <= 122):
+        return 0
+    class_from = _char_class(c_prev, c_from)
+    class_to = _char_class(c_prev, c_to)
+    if class_from == class_to:
+        return 40
+    if CCLASS_B <= class_from <= CCLASS_Y and CCLASS_B <= class_to <= CCLASS_Y:
+        return 75
+    return 100
+
+
+out_of_reach = 1 << 30
+
+# costs only depend on the surrounding characters, so they get looked up from tables
+# that are filled in as new character combinations show up (0xFF - not calculated yet)
+_ins_del_costs = bytearray(b"\xff" * (1 << 21))
+_sub_costs = bytearray(b"\xff" * (1 << 21))
+
+
+def ins_del_cost(c_prev, c, c_next):
+    k = (c_prev & 0x7F) << 14 | (c & 0x7F) << 7 | (c_next & 0x7F)
+    cost = _ins_del_costs[k]
+    if cost == 0xFF:
+        cost = _ins_del_costs[k] = _ins_del_cost(c_prev, c, c_next)
+    return cost
+
+
+def sub_cost(c_prev, c_from, c_to):
+    k = (c_prev & 0x7F) << 14 | (c_from & 0x7F) << 7 | (c_to & 0x7F)
+    cost = _sub_costs[k]
+    if cost == 0xFF:
+        cost = _sub_costs[k] = _sub_cost(c_prev, c_from, c_to)
+    return cost
+
+
+def first_row(b, dc):
+    # the initial matrix row only depends on the query
+    m = [0] * (len(b) + 1)
+    cx = [0] * (len(b) + 1)
+    cx[0] = dc
+    c_prev = dc
+    for x_b in range(1, len(b) + 1):
+        c_b = b[x_b - 1]
+        c_next = b[x_b] if x_b < len(b) else 0
+        cx[x_b] = c_b
+        m[x_b] = m[x_b - 1] + ins_del_cost(c_prev, c_b, c_next)
+        c_prev = c_b
+    return m, cx
+
+
+def last_within(m, cutoff):
+    # the last column of a row that's within the cutoff, -1 if there's none
+    for x in range(len(m) - 1, -1, -1):
+        if m[x] <= cutoff:
+            return x
+    return -1
+
+
+def next_row(m, cx, b, c_a_prev, c_a, c_a_next, last_a, cutoff=None, last=None):
+    # returns the matrix row for c_a along with its smallest value, and the last column
+    # that's within the cutoff
+    #
+    # cutoff, last - columns to the right of the previous row's last one within the cutoff
+    # can only get back under it through insertions from the left, so the row stops as
+    # soon as that can't happen anymore (the rest of it is set to out_of_reach)
+    m = m[:]
+    cx = cx[:]
+    n_b = len(b)
+    if cutoff is None:
+        cutoff = out_of_reach
+        last = n_b
+    d = m[0]
+    m[0] = d + ins_del_cost(c_a_prev, c_a, c_a_next)
+    row_min = m[0]
+    new_last = 0 if m[0] <= cutoff else -1
+    # the cost table lookups are inlined, this loop is where searches spend their time
+    ins_del_costs = _ins_del_costs
+    sub_costs = _sub_costs
+    k_a = (c_a & 0x7F) << 7
+    for x_b in range(1, n_b + 1):
+        if x_b > last + 1 and m[x_b - 1] > cutoff:
+            m[x_b:] = [out_of_reach] * (n_b + 1 - x_b)
+            break
+        c_b = b[x_b - 1]
+        c_b_next = b[x_b] if x_b < n_b else 0
+        k_prev = (cx[x_b - 1] & 0x7F) << 14
+
+        ins_cost = ins_del_costs[k_prev | (c_b & 0x7F) << 7 | (c_b_next & 0x7F)]
+        if ins_cost == 0xFF:
+            ins_cost = ins_del_cost(cx[x_b - 1], c_b, c_b_next)
+        if last_a:
+            ins_cost //= FINAL_INS_COST_DIV
+        del_cost = ins_del_costs[(cx[x_b] & 0x7F) << 14 | k_a | (c_b_next & 0x7F)]
+        if del_cost == 0xFF:
+            del_cost = ins_del_cost(cx[x_b], c_a, c_b_next)
+        sub = sub_costs[k_prev | k_a | (c_b & 0x7F)]
+        if sub == 0xFF:
+            sub = sub_cost(cx[x_b - 1], c_a, c_b)
+
+        total_cost = ins_cost + m[x_b - 1]
+        ncx = c_b
+        if del_cost + m[x_b] < total_cost:
+            total_cost = del_cost + m[x_b]
+            ncx = c_a
+        if sub + d < total_cost:
+            total_cost = sub + d
+
+        d = m[x_b]
+        m[x_b] = total_cost
+        cx[x_b] = ncx
+        if total_cost < row_min:
+            row_min = total_cost
+        if total_cost <= cutoff:
+            new_last = x_b
+    return m, cx, row_min, new_last
+
+
+def insert_cost(b, dc):
+    # cost of a being a prefix of b
+    res = 0
+    c_prev = dc
+    for x in range(len(b)):
+        c_next = b[x + 1] if x + 1 < len(b) else 0
+        res += ins_del_cost(c_prev, b[x], c_next) // FINAL_INS_COST_DIV
+        c_prev = b[x]
+    return res
+
+
+def editdist(a, b):
+    # a, b - ascii bytes
+    prefix = 0
+    while prefix < len(a) and prefix < len(b) and a[prefix] == b[prefix]:
+        prefix += 1
+    dc = a[prefix - 1] if prefix > 0 else 0
+    a = a[prefix:]
+    b = b[prefix:]
+    if len(a) == 0:
+        return insert_cost(b, dc)
+    if len(b) == 0:
+        res = 0
+        c_prev = dc
+        for x in range(len(a)):
+            c_next = a[x + 1] if x + 1 < len(a) else 0
+            res += ins_del_cost(c_prev, a[x], c_next)
+            c_prev = a[x]
+        return res
+    if a == b"*":
+        return 0
+
+    m, cx = first_row(b, dc)
+    c_a_prev = dc
+    c_a = 0
+    for x_a in range(1, len(a) + 1):
+        last_a = x_a == len(a)
+        c_a = a[x_a - 1]
+        if c_a == 42 and last_a:  # '*'
+            break
+        c_a_next = a[x_a] if x_a < len(a) else 0
+        m, cx, _, _ = next_row(m, cx, b, c_a_prev, c_a, c_a_next, last_a)
+        c_a_prev = c_a
+    return min(m[1:]) if c_a == 42 else m[len(b)]
+
+
+# the search is plain Python, so its cost has to be bounded for queries that are nowhere
+# near any name (long garbage input would otherwise walk most of the trie with a cutoff
+# that never tightens) - names further away than max_cost (~3 typos) don't get searched
+# for, the best trigram candidate gets returned instead. Anything within it is exact
+max_cost = 300
+
+
+def get_trigrams(s):
+    s = f"  {s} "
+    return {s[i : i + 3] for i in range(len(s) - 2)}
+
+
+class TrieNode:
+    __slots__ = ("children", "names")
+
+    def __init__(self):
+        self.children = {}
+        self.names = []
+
+
+class NameIndex:
+    # search names get stored in a trie, so that names with a common prefix share the
+    # edit distance matrix rows, and whole branches get skipped as soon as the smallest
+    # value in a row is worse than the best match so far (costs are never negative, so
+    # values never go down further along a branch)
+    #
+    # a trigram inverted index is used to pick the first few candidates, which means that
+    # the search starts out with a tight cutoff
+    def __init__(self, cities):
+        # cities - rows of (id, name, lat, lon, type, search_name), in table order
+        names = {}
+        for i, c in enumerate(cities):
+            city = (c[0], c[1], c[2], c[3], ctypes.get(c[4]))
+            names.setdefault(c[5], []).append((ctype_rank(city[4]), i, c[4], city))
+        self.names = list(names.keys())
+        self.encoded = [n.encode("ascii", "replace") for n in self.names]
+        self.cities = [sorted(names[n], key=lambda e: e[:2]) for n in self.names]
+
+        self.trigrams = {}
+        self.root = TrieNode()
+        for i, n in enumerate(self.names):
+            for t in get_trigrams(n):
+                self.trigrams.setdefault(t, []).append(i)
+            node = self.root
+            for c in self.encoded[i]:
+                node = node.children.setdefault(c, TrieNode())
+            node.names.append(i)
+        self.find = lru_cache(maxsize=4096)(self._find)
+        self.get_allowed = lru_cache(maxsize=8)(self._get_allowed)
+
+    def __len__(self):
+        return len(self.names)
+
+    def _get_allowed(self, types):
+        # the highest priority city for every name that has cities of the given types
+        allowed = {}
+        for i, cities in enumerate(self.cities):
+            tmp = [e for e in cities if e[2] in types]
+            if len(tmp) > 0:
+                allowed[i] = tmp[0]
+        return allowed
+
+    def _find(self, search_name, types):
+        query = search_name.encode("ascii", "replace")
+        allowed = self.get_allowed(types)
+
+        scores = {}
+        for t in get_trigrams(search_name):
+            for i in self.trigrams.get(t, []):
+                if i in allowed:
+                    scores[i] = scores.get(i, 0) + 1
+        found = {
+            i: editdist(self.encoded[i], query)
+            for i in sorted(scores, key=lambda i: -scores[i])[:10]
+        }
+        search = TrieSearch(query, allowed, found)
+        search.run(self.root)
+
+        if len(search.found) == 0:
+            return ()
+        # ordering by distance, then ctype, then by position in the table
+        best = min(search.found.values())
+        best_i = min(
+            [i for i, d in search.found.items() if d == best],
+            key=lambda i: allowed[i][:2],
+        )
+        return (*allowed[best_i][3], best)
+
+    def closest(self, search_name, types):
+        return self.find(search_name, tuple(types))
+
+
+class TrieSearch:
+    def __init__(self, query, allowed, found):
+        self.query = query
+        self.allowed = allowed
+        self.found = found
+        self.cutoff = min([max_cost, *found.values()])
+
+    def within(self, cost):
+        return cost <= self.cutoff
+
+    def report(self, names, cost):
+        for i in names:
+            if i in self.allowed and self.within(cost):
+                self.found[i] = cost
+                self.cutoff = cost
+
+    def run(self, root):
+        # walking down the common prefix first, since editdist() skips it
+        node = root
+        query = self.query
+        for p in range(len(query) + 1):
+            dc = query[p - 1] if p > 0 else 0
+            rest = query[p:]
+            self.report(node.names, insert_cost(rest, dc))
+            if p == len(query):
+                for c, child in node.children.items():
+                    self.walk_deletes(child, c, dc, 0)
+                break
+            m, cx = first_row(rest, dc)
+            last = last_within(m, self.cutoff)
+            for c, child in node.children.items():
+                if c != query[p]:
+                    self.walk_rows(child, c, dc, m, cx, rest, last)
+            node = node.children.get(query[p])
+            if node is None:
+                break
+
+    def walk_deletes(self, node, c, c_prev, cost):
+        # the whole query has been matched, the rest of the name has to be deleted
+        if len(node.names) > 0:
+            self.report(node.names, cost + ins_del_cost(c_prev, c, 0))
+        for c_next, child in node.children.items():
+            next_cost = cost + ins_del_cost(c_prev, c, c_next)
+            if self.within(next_cost):
+                self.walk_deletes(child, c_next, c, next_cost)
+
+    def walk_rows(self, node, c_a, c_a_prev, m, cx, b, last):
+        if len(node.names) > 0:
+            last_m, _, _, _ = next_row(
+                m, cx, b, c_a_prev, c_a, 0, True, self.cutoff, last
+            )
+            self.report(node.names, last_m[len(b)])
+        for c_a_next, child in node.children.items():
+            next_m, next_cx, row_min, next_last = next_row(
+                m, cx, b, c_a_prev, c_a, c_a_next, False, self.cutoff, last
+            )
+            if self.within(row_min):
+                self.walk_rows(child, c_a_next, c_a, next_m, next_cx, b, next_last)
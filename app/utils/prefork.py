@@ -0,0 +1,63 @@
+import os
+import gc
+import signal
+import socket
+import logging
+
+import uvicorn
+
+
+def serve_prefork(app, workers, host, port, log_config):
+    # the parent binds the socket and forks the workers, which all accept on it - anything
+    # that has been loaded by now (indexes etc.) is shared between them copy-on-write
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(2048)
+    sock.set_inheritable(True)
+
+    # moving everything that exists at this point out of the gc's reach, otherwise the
+    # first collection in each worker touches (and copies) every shared page
+    gc.freeze()
+
+    def start_worker():
+        pid = os.fork()
+        if pid == 0:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            config = uvicorn.Config(app, log_config=log_config)
+            uvicorn.Server(config).run(sockets=[sock])
+            os._exit(0)
+        return pid
+
+    children = {start_worker() for _ in range(workers)}
+    logging.info(f"Started {workers} workers on {host}:{port} - {sorted(children)}")
+
+    stopping = False
+
+    def stop(signum, _):
+        nonlocal stopping
+        stopping = True
+        for pid in children:
+            try:
+                os.kill(pid, signum)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    while len(children) > 0:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        except InterruptedError:
+            continue
+        children.discard(pid)
+        if not stopping:
+            logging.error(
+                f"Worker {pid} exited (status {os.waitstatus_to_exitcode(status)}) - restarting"
+            )
+            children.add(start_worker())
+    sock.close()
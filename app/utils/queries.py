@@ -0,0 +1,109 @@
+from utils.utils import daily_params, hourly_params
+
+# every request runs the same handful of statements - keeping the sql text constant and
+# binding the values means that sqlite3's per-connection statement cache only has to
+# parse and plan each of them once, rather than once per request
+
+missing_param_cities = "SELECT city_id FROM missing_params"
+
+cities = "SELECT id, name, lat, lon, type, search_name FROM cities"
+
+city_grid = """
+    SELECT
+        city_id
+    FROM
+        city_grid
+    WHERE
+        location_range = :location_range AND lat_idx = :lat_idx AND lon_start <= :lon_idx
+    ORDER BY
+        lon_start DESC
+    LIMIT 1
+"""
+
+
+def get_forecast_query(table_name, params):
+    # table and column names can't be bound, but they're fixed for the lifetime of the app
+    return f"""
+        SELECT
+            city_id, date, time,
+            {",".join([f"val_{p}" for p in params])}
+        FROM
+            {table_name}
+        WHERE
+            city_id IN (SELECT value FROM json_each(:city_ids)) AND date >= :c_date
+        ORDER BY
+            city_id, date
+    """
+
+
+forecast_hourly = get_forecast_query("forecast_cities_hourly", hourly_params)
+
+forecast_daily = get_forecast_query("forecast_cities_daily", daily_params)
+
+
+def get_warning_query(columns):
+    # the download jobs have already dropped duplicate warnings, and worked out which
+    # ones apply to which city
+    return f"""
+        SELECT DISTINCT
+            w.id,
+            {",".join([f"w.{c}" for c in columns])}
+        FROM
+            city_warnings AS cw INNER JOIN active_warnings AS w ON
+                w.id = cw.warning_id
+        WHERE
+            cw.city_id = :city_id AND w.time_to > :c_date
+        ORDER BY
+            w.intensity_val DESC
+    """
+
+
+warnings = get_warning_query(
+    [
+        "intensity_lv",
+        "intensity_en",
+        "regions_lv",
+        "regions_en",
+        "type_lv",
+        "type_en",
+        "time_from",
+        "time_to",
+        "description_lv",
+        "description_en",
+    ]
+)
+
+simple_warnings = get_warning_query(
+    [
+        "type_lv",
+        "type_en",
+        "intensity_lv",
+        "intensity_en",
+        "description_lv",
+        "description_en",
+        "time_to",
+    ]
+)
+
+
+def get_uptime_column(period):
+    return f"""(1.0-1.0*SUM(CASE
+                WHEN start_time >= (:now-{period}) THEN duration
+                WHEN start_time < (:now-{period}) AND start_time+duration >= (:now-{period}) THEN duration-(:now-{period}-start_time)
+                ELSE 0
+            END)/MIN({period}, (:now-MIN(start_time))))*100"""
+
+
+uptimes = f"""
+    SELECT
+        type,
+        (1.0-1.0*SUM(duration)/(:now-MIN(start_time)))*100 AS total,
+        {get_uptime_column("(60*60*24*90)")} AS ninety,
+        {get_uptime_column("(60*60*24*30)")} AS thirty,
+        {get_uptime_column("(60*60*24*7)")} AS seven,
+        {get_uptime_column("(60*60*24)")} AS one
+    FROM
+        downtimes
+    GROUP BY
+        type
+"""
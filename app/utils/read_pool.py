@@ -0,0 +1,41 @@
+import os
+import sqlite3
+import threading
+
+
+class ReadPool:
+    # sqlite connections can't be shared between threads, so every worker thread gets a
+    # read-only connection of its own
+    def __init__(self, db_file, timeout=5):
+        self.db_file = db_file
+        self.timeout = timeout
+        self.local = threading.local()
+        # connections can't be carried over into a forked process either - workers open
+        # their own
+        os.register_at_fork(after_in_child=self.reset)
+
+    def reset(self):
+        self.local = threading.local()
+
+    def connect(self):
+        # download jobs never write to the published file, they swap in a new one instead -
+        # so there's nothing to lock, and an open connection keeps reading the generation
+        # that it was opened on until it gets replaced
+        con = sqlite3.connect(
+            f"file:{self.db_file}?immutable=1", uri=True, timeout=self.timeout
+        )
+        con.execute("PRAGMA query_only=ON")
+        return con
+
+    def cursor(self, generation=None):
+        # the cursor doesn't actually do anything in sqlite3, just reusing it
+        # https://stackoverflow.com/questions/54395773/what-are-the-side-effects-of-reusing-a-sqlite3-cursor
+        local = self.local
+        cur = getattr(local, "cur", None)
+        if cur is not None and local.generation != generation:
+            cur.connection.close()  # a newer db file has been swapped in
+            cur = None
+        if cur is None:
+            cur = local.cur = self.connect().cursor()
+            local.generation = generation
+        return cur
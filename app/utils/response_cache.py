@@ -0,0 +1,57 @@
+import threading
+from collections import OrderedDict
+
+
+class ResponseCache:
+    # LRU cache for responses that only change when new data gets downloaded, or when
+    # some part of them (the first forecast entry, a warning) goes out of date
+    def __init__(self, max_size=4096):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.generation = None
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+
+    def _check_generation(self, generation):
+        if generation != self.generation:
+            self.entries.clear()
+            self.generation = generation
+
+    def get(self, key, generation, c_date):
+        # c_date - YYYYMMDDHHMM as an int
+        with self.lock:
+            self._check_generation(generation)
+            entry = self.entries.get(key)
+            if entry is not None:
+                value, valid_until, valid_before = entry
+                if c_date <= valid_until and c_date < valid_before:
+                    self.entries.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self.entries[key]
+                self.expired += 1
+            self.misses += 1
+            return None
+
+    def put(self, key, generation, value, valid_until, valid_before):
+        # valid_until - last c_date (inclusive) for which the value is still correct
+        # valid_before - first c_date for which the value is no longer correct
+        with self.lock:
+            self._check_generation(generation)
+            self.entries[key] = (value, valid_until, valid_before)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def stats(self):
+        with self.lock:
+            total = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "expired": self.expired,
+                "size": len(self.entries),
+                "hit_ratio": self.hits / total if total > 0 else 0.0,
+            }
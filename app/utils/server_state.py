@@ -0,0 +1,146 @@
+import os
+import json
+import logging
+import datetime
+import threading
+from typing import NamedTuple
+
+import pytz
+
+from utils.aurora_grid import AuroraGrid
+from utils.settings import (
+    aurora_grid_file,
+    data_folder,
+    generation_file,
+    last_updated,
+    run_emergency,
+    run_emergency_failed,
+    update_failed,
+)
+
+metadata_file = (
+    f"{data_folder}meteorologiskas-prognozes-apdzivotam-vietam-jaunaka-datu-kopa.json"
+)
+version_file = "version.txt"
+
+# everything the request path used to read from disk - a new snapshot gets built
+# whenever any of these files change
+watched_files = (
+    generation_file,
+    metadata_file,
+    aurora_grid_file,
+    last_updated,
+    run_emergency,
+    run_emergency_failed,
+    update_failed,
+    version_file,
+)
+
+
+class ServerState(NamedTuple):
+    mtimes: tuple
+    generation: float
+    last_updated: str
+    last_downloaded: str
+    aurora_time: datetime.datetime
+    aurora_grid: AuroraGrid | None
+    last_downloaded_no_skip: str
+    is_emergency: bool
+    emergency_dl: str
+    has_emergency_failed: bool
+    update_failed: str
+    version: str
+    version_updated: str
+
+
+def get_mtimes():
+    mtimes = []
+    for fpath in watched_files:
+        try:
+            mtimes.append(os.stat(fpath).st_mtime)
+        except FileNotFoundError:
+            mtimes.append(None)
+    return tuple(mtimes)
+
+
+def read_file(fpath, default=""):
+    try:
+        with open(fpath, "r") as f:
+            return f.read()
+    except FileNotFoundError:
+        return default
+
+
+def read_line(fpath):
+    try:
+        with open(fpath, "r") as f:
+            return f.readline()
+    except FileNotFoundError:
+        return ""
+
+
+def mtime_to_str(mtime):
+    if mtime is None:
+        return ""
+    return (
+        datetime.datetime.fromtimestamp(mtime)
+        .replace(tzinfo=pytz.timezone("UTC"))
+        .astimezone(pytz.timezone("Europe/Riga"))
+        .strftime("%Y%m%d%H%M")
+    )
+
+
+def load_state(mtimes):
+    mtime = dict(zip(watched_files, mtimes))
+
+    metadata = json.loads(read_file(metadata_file, "{}"))
+    metadata_modified = metadata.get("result", {}).get("metadata_modified", "")
+
+    # the grid gets mapped rather than read - the download job replaces the file instead
+    # of writing into it, so an old mapping stays valid until the snapshot is dropped
+    aurora_grid = None
+    if mtime[aurora_grid_file] is not None:
+        try:
+            aurora_grid = AuroraGrid(aurora_grid_file)
+        except (FileNotFoundError, ValueError) as e:
+            logging.error(f"Aurora grid not loaded - {e}")
+    aurora_time = datetime.datetime.fromtimestamp(
+        aurora_grid.forecast_time if aurora_grid is not None else 0,
+        pytz.timezone("UTC"),
+    ).astimezone(pytz.timezone("Europe/Riga"))
+
+    return ServerState(
+        mtimes=mtimes,
+        generation=mtime[generation_file] or 0,
+        last_updated=metadata_modified.replace("-", "")
+        .replace("T", "")
+        .replace(":", "")[:12],
+        last_downloaded=mtime_to_str(mtime[metadata_file]),
+        aurora_time=aurora_time,
+        aurora_grid=aurora_grid,
+        last_downloaded_no_skip=read_line(last_updated).strip(),
+        is_emergency=mtime[run_emergency] is not None,
+        emergency_dl=read_line(run_emergency),
+        has_emergency_failed=mtime[run_emergency_failed] is not None,
+        update_failed=read_line(update_failed).strip(),
+        version=read_file(version_file).strip(),
+        version_updated=mtime_to_str(mtime[version_file]),
+    )
+
+
+class ServerStateWatcher:
+    # requests only ever look at self.current - it gets swapped for a new snapshot by the
+    # background poller, so the request path doesn't have to touch the filesystem
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.current = load_state(get_mtimes())
+
+    def refresh(self):
+        # returns True if anything changed
+        with self.lock:
+            mtimes = get_mtimes()
+            if mtimes == self.current.mtimes:
+                return False
+            self.current = load_state(mtimes)
+            logging.info("Server state reloaded")
+            return True
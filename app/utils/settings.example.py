@@ -3,5 +3,7 @@ data_uptimerobot_folder = "/data_uptimerobot/"
 db_file = f"{data_folder}meteo.db"
 run_emergency = f"{data_folder}run_emergency"
 run_emergency_failed = f"{data_folder}run_emergency_failed"
+update_failed = f"{data_folder}update_failed"
 last_updated = f"{data_folder}last_updated"
-editdist_extension = "/sqlite_extensions/fuzzy.so"
+generation_file = f"{data_folder}generation"
+aurora_grid_file = f"{data_folder}ovation_aurora.grid"
@@ -0,0 +1,220 @@
+import os
+import json
+import time
+import bisect
+import functools
+import threading
+
+# seconds - most of the request path should land in the sub-millisecond buckets, the
+# upper ones are there to catch cache misses and slow queries
+default_buckets = (
+    0.00005,
+    0.0001,
+    0.00025,
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+)
+
+
+def format_value(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Histogram:
+    # fixed buckets, so observing is a bisect and a few additions - cumulative counts
+    # only get worked out when rendering
+    __slots__ = ("buckets", "counts", "sum", "count", "lock")
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        i = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[i] += 1
+            self.sum += value
+            self.count += 1
+
+    def snapshot(self):
+        with self.lock:
+            return list(self.counts), self.sum, self.count
+
+
+class Timer:
+    __slots__ = ("histogram", "start")
+
+    def __init__(self, histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *_):
+        self.histogram.observe(time.perf_counter() - self.start)
+        return False
+
+
+class HistogramFamily:
+    # one histogram per label value, e.g. per stage of the request path
+    def __init__(self, name, description, label, buckets=default_buckets):
+        self.name = name
+        self.description = description
+        self.label = label
+        self.buckets = buckets
+        self.histograms = {}
+        self.lock = threading.Lock()
+
+    def get(self, label_value):
+        histogram = self.histograms.get(label_value)
+        if histogram is None:
+            with self.lock:
+                histogram = self.histograms.setdefault(
+                    label_value, Histogram(self.buckets)
+                )
+        return histogram
+
+    def time(self, label_value):
+        return Timer(self.get(label_value))
+
+    def timed(self, label_value):
+        # for whole endpoints - functools.wraps keeps the signature visible to FastAPI
+        def decorator(f):
+            @functools.wraps(f)
+            def wrapper(*args, **kwargs):
+                with self.time(label_value):
+                    return f(*args, **kwargs)
+
+            return wrapper
+
+        return decorator
+
+    def snapshot(self):
+        # label value -> (counts, sum, count)
+        with self.lock:
+            histograms = list(self.histograms.items())
+        return {label_value: h.snapshot() for label_value, h in histograms}
+
+    def render(self, histograms):
+        # histograms - the (summed up) snapshots of every worker
+        lines = [
+            f"# HELP {self.name} {self.description}",
+            f"# TYPE {self.name} histogram",
+        ]
+        for label_value, (counts, total, count) in sorted(histograms.items()):
+            labels = f'{self.label}="{label_value}"'
+            cumulative = 0
+            for le, c in zip(self.buckets, counts):
+                cumulative += c
+                lines.append(
+                    f'{self.name}_bucket{{{labels},le="{format_value(le)}"}} {cumulative}'
+                )
+            lines.append(f'{self.name}_bucket{{{labels},le="+Inf"}} {count}')
+            lines.append(f"{self.name}_sum{{{labels}}} {format_value(total)}")
+            lines.append(f"{self.name}_count{{{labels}}} {count}")
+        return lines
+
+
+def is_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class StageMetrics:
+    # every worker only sees the requests it has handled itself - with several of them,
+    # shared_dir gets set before they're forked, each of them writes its numbers there
+    # (share() - called every second, and on every scrape), and render() adds them up.
+    # The files of workers that have exited stay, so that counters never go down, but
+    # their gauges don't get counted
+    def __init__(self):
+        self.families = []
+        self.collectors = []
+        self.shared_dir = None
+
+    def histogram(self, name, description, label):
+        family = HistogramFamily(name, description, label)
+        self.families.append(family)
+        return family
+
+    def add_collector(self, collector):
+        # collector - callable returning (name, type, description, value) tuples, for
+        # counters and gauges that are kept elsewhere (e.g. the response cache)
+        self.collectors.append(collector)
+
+    def snapshot(self):
+        return {
+            "pid": os.getpid(),
+            "histograms": {f.name: f.snapshot() for f in self.families},
+            "values": [list(m) for c in self.collectors for m in c()],
+        }
+
+    def share(self):
+        if self.shared_dir is None:
+            return
+        fpath = f"{self.shared_dir}/{os.getpid()}.json"
+        with open(f"{fpath}.tmp", "w") as f:
+            json.dump(self.snapshot(), f)
+        os.replace(f"{fpath}.tmp", fpath)
+
+    def get_snapshots(self):
+        if self.shared_dir is None:
+            return [self.snapshot()]
+        self.share()
+        snapshots = []
+        for fname in os.listdir(self.shared_dir):
+            if fname.endswith(".json"):
+                try:
+                    with open(f"{self.shared_dir}/{fname}") as f:
+                        snapshots.append(json.load(f))
+                except (FileNotFoundError, ValueError):
+                    pass  # replaced while it was being read
+        return snapshots
+
+    def collect(self):
+        # returns the histograms and collector values summed up across workers
+        histograms = {f.name: {} for f in self.families}
+        values = {}
+        for snapshot in self.get_snapshots():
+            alive = is_alive(snapshot["pid"])
+            for name, family in snapshot["histograms"].items():
+                for label_value, (counts, total, count) in family.items():
+                    prev = histograms.setdefault(name, {}).get(label_value)
+                    if prev is not None:
+                        counts = [a + b for a, b in zip(prev[0], counts)]
+                        total += prev[1]
+                        count += prev[2]
+                    histograms[name][label_value] = (counts, total, count)
+            for name, metric_type, _, value in snapshot["values"]:
+                if metric_type == "counter" or alive:
+                    values[name] = values.get(name, 0) + value
+        return histograms, values
+
+    def render(self):
+        histograms, values = self.collect()
+        lines = []
+        for family in self.families:
+            lines.extend(family.render(histograms[family.name]))
+        for collector in self.collectors:
+            for name, metric_type, description, _ in collector():
+                lines.append(f"# HELP {name} {description}")
+                lines.append(f"# TYPE {name} {metric_type}")
+                lines.append(f"{name} {format_value(values.get(name, 0))}")
+        return "\n".join(lines) + "\n"
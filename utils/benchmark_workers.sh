@@ -0,0 +1,24 @@
+# throughput at different worker counts - starts a second server on port 8001 inside of the
+# running app container (so that it sees the same db), and points locust at it
+# usage: bash utils/benchmark_workers.sh [users] [run time]
+cd ~/meteo_server
+
+users=${1:-100}
+run_time=${2:-60s}
+container=meteo_server-app-1
+out=$(mktemp -d)
+
+for workers in 1 2 4 8; do
+    docker exec -d -e WORKERS=$workers -e HOST=0.0.0.0 -e PORT=8001 $container sh -c 'uv run main.py & echo $! > /tmp/benchmark.pid; wait'
+    sleep 10 # indexes get built before the workers start
+
+    docker run --rm --network container:$container -v "$(pwd)/utils:/mnt/locust" -v "$out:/out" locustio/locust \
+        -f /mnt/locust/locustfile.py --headless -u $users -r $users -t $run_time \
+        -H http://localhost:8001 --csv /out/workers_$workers > /dev/null 2>&1
+
+    docker exec $container sh -c 'kill $(cat /tmp/benchmark.pid)'
+    sleep 5
+
+    # Requests/s of the Aggregated row
+    echo "$workers workers: $(awk -F, '$2 == "Aggregated" {print $10}' $out/workers_${workers}_stats.csv) req/s"
+done